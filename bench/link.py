@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""Measure portsh over a simulated serial link to a fake device.
+
+The link is a pair of ptys with a relay between them that limits
+bandwidth, adds latency and flips random bits.  Behind it, the fake
+device asks for a login and password, then runs an interactive shell
+with a python of our choosing on its PATH, so portsh's login, stage2
+upload and assembler all run the same way they would on real hardware.
+"""
+import os, sys, pty, tty, termios, fcntl, select, signal, random
+import json, subprocess, tempfile, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import options
+
+optspec = """
+link.py [options...]
+--
+b,bps=      simulated link speed in bits per second, 0 for unlimited [115200]
+l,latency=  one-way delay in milliseconds [0]
+e,errors=   chance of corrupting each byte [0]
+s,sizes=    payload sizes for the throughput tests [1024,16384,131072]
+python=     python for the fake device to run stage2 with (default: this one)
+"""
+
+PORTSH = os.path.join(os.path.dirname(__file__), '..', 'portsh.py')
+
+
+class Link(object):
+    """A fake device behind a simulated serial link.
+
+    Open tty (a pty) to talk to the device.  Bytes take 10 bit times each
+    at bps, plus latency seconds, to arrive at the other end, and each one
+    has an errors chance of having a random bit flipped on the way.
+    """
+
+    def __init__(self, bps=0, latency=0, errors=0, python=None):
+        self.bps = bps
+        self.latency = latency
+        self.errors = errors
+        self.bindir = tempfile.mkdtemp(prefix='portsh-bench.')
+        os.symlink(python or sys.executable,
+                   os.path.join(self.bindir, 'python'))
+        self.host, slave = pty.openpty()
+        self.tty = os.ttyname(slave)
+        tty.setraw(self.host)
+        dev, dev_slave = pty.openpty()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(self.host)
+            os.close(slave)
+            os.close(dev)
+            self._device(dev_slave)
+        os.close(dev_slave)
+        self.dev = dev
+        self.running = True
+        # Keep the slave open so the relay never sees a hangup between
+        # portsh runs.
+        self.slave = slave
+        self.thread = threading.Thread(target=self._relay)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _device(self, fd):
+        os.setsid()
+        fcntl.ioctl(fd, termios.TIOCSCTTY, 0)
+        for i in (0, 1, 2):
+            os.dup2(fd, i)
+        os.environ['PATH'] = '%s:%s' % (self.bindir, os.environ['PATH'])
+        os.environ['PS1'] = '# '
+        # portsh sends ^C and friends to get our attention at login.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+        for prompt in ('login: ', 'Password: '):
+            while 1:
+                os.write(1, prompt)
+                if os.read(0, 1024).strip('\x03\x04\x1c\r\n'):
+                    break
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+        os.execvp('sh', ['sh', '-i'])
+
+    def _mangle(self, b):
+        if not self.errors:
+            return b
+        b = bytearray(b)
+        for i in range(len(b)):
+            if random.random() < self.errors:
+                b[i] ^= 1 << random.randrange(8)
+        return str(b)
+
+    def _relay(self):
+        # Each direction is a queue of (arrival time, bytes), plus the time
+        # at which the simulated wire is free to carry more.
+        queues = {self.host: [], self.dev: []}
+        free = {self.host: 0, self.dev: 0}
+        peer = {self.host: self.dev, self.dev: self.host}
+        chunk = self.bps and max(1, self.bps // 1000) or 4096
+        while self.running:
+            now = time.time()
+            timeout = 0.1
+            for q in queues.values():
+                if q:
+                    timeout = min(timeout, max(0, q[0][0] - now))
+            r,w,x = select.select(queues.keys(), [], [], timeout)
+            now = time.time()
+            for src in r:
+                try:
+                    b = os.read(src, chunk)
+                except OSError:
+                    b = ''
+                if not b:
+                    continue
+                done = max(now, free[src])
+                if self.bps:
+                    done += len(b) * 10.0 / self.bps
+                free[src] = done
+                queues[src].append((done + self.latency, self._mangle(b)))
+            for src, q in queues.items():
+                while q and q[0][0] <= now:
+                    os.write(peer[src], q.pop(0)[1])
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        for fd in (self.host, self.slave, self.dev):
+            os.close(fd)
+        os.unlink(os.path.join(self.bindir, 'python'))
+        os.rmdir(self.bindir)
+
+
+def portsh(link, *args, **kwargs):
+    """Run portsh against link; return (seconds, time to first byte, output).
+
+    The time to first byte is None if the command printed nothing.  Extra
+    options for portsh can be given as a list in opts.
+    """
+    args = list(args)
+    args.insert(args[0] in ('push', 'pull') and 1 or 0, link.tty)
+    start = time.time()
+    p = subprocess.Popen([sys.executable, PORTSH, '-p', 'x'] +
+                         kwargs.get('opts', []) + args,
+                         stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    first = None
+    out = ''
+    while 1:
+        b = os.read(p.stdout.fileno(), 65536)
+        if not b:
+            break
+        if first is None:
+            first = time.time() - start
+        out += b
+    if p.wait() != kwargs.get('rv', 0):
+        raise Exception('portsh %r exited with code %d' % (args, p.returncode))
+    return time.time() - start, first, out
+
+
+def exec_time(link, tmp, *args):
+    """Run portsh against link; return (seconds after logging in, output).
+
+    That's the time the transfer itself took, as portsh's --stats-json
+    measures it, with nothing of the login or stage2 startup in it.
+    """
+    report = os.path.join(tmp, 'stats.json')
+    out = portsh(link, opts=['--stats-json', report], *args)[2]
+    f = open(report)
+    try:
+        return json.load(f)['phases']['exec'], out
+    finally:
+        f.close()
+        os.unlink(report)
+
+
+def _clear_cache():
+    """Forget the stage2 scripts cached by earlier runs."""
+    for d in ('/dev/shm', '/tmp'):
+        if os.path.isdir(d):
+            for name in os.listdir(d):
+                path = os.path.join(d, name)
+                if name.startswith('portsh-') and os.path.isfile(path):
+                    os.unlink(path)
+
+
+def _rate(size, secs):
+    return '%10.0f' % (size / max(secs, 1e-6))
+
+
+def main():
+    o = options.Options(optspec)
+    (opt, flags, extra) = o.parse(sys.argv[1:])
+    if extra:
+        o.fatal('no arguments expected')
+    link = Link(int(opt.bps), float(opt.latency) / 1000, float(opt.errors),
+                opt.python)
+    tmp = tempfile.mkdtemp(prefix='portsh-bench.')
+    try:
+        print 'link: %s bps, %s ms latency, %s error rate' % (
+            opt.bps, opt.latency, opt.errors)
+        _clear_cache()
+        cold = portsh(link, 'true')[0]
+        warm = portsh(link, 'true')[0]
+        secs, ttfb, out = portsh(link, 'echo hello')
+        print '%-28s %8.3fs' % ('login+bootstrap (cold)', cold)
+        print '%-28s %8.3fs' % ('login+bootstrap (warm)', warm)
+        print '%-28s %8.3fs' % ('time to first byte', ttfb)
+        print
+        print '%10s %10s %10s %10s' % ('bytes', 'run B/s', 'push B/s',
+                                       'pull B/s')
+        for size in [int(v) for v in opt.sizes.split(',')]:
+            src = os.path.join(tmp, 'src')
+            dst = os.path.join(tmp, 'dst')
+            open(src, 'wb').write(os.urandom(size))
+            run, out = exec_time(link, tmp, 'cat %s' % src)
+            assert out == open(src, 'rb').read()
+            push = exec_time(link, tmp, 'push', src, dst)[0]
+            assert open(dst, 'rb').read() == open(src, 'rb').read()
+            os.unlink(dst)
+            pull = exec_time(link, tmp, 'pull', src, dst)[0]
+            assert open(dst, 'rb').read() == open(src, 'rb').read()
+            print '%10d %s %s %s' % (size, _rate(size, run),
+                                     _rate(size, push), _rate(size, pull))
+    finally:
+        for name in os.listdir(tmp):
+            os.unlink(os.path.join(tmp, name))
+        os.rmdir(tmp)
+        link.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""Measure portsh.Reader's per-byte cost as the size of a burst grows.
+
+Each burst is fed to the Reader in 4096-byte pieces, the way fill() would
+read it from the tty, and only then split into lines, like a remote
+command dumping megabytes faster than we get around to parsing them.
+The time per byte should stay flat as the burst grows.
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import portsh
+
+
+def run(burst, linelen):
+    line = 'x' * (linelen - 2) + '\r\n'
+    data = line * (burst // linelen)
+    r = portsh.Reader(None)
+    start = time.time()
+    for i in range(0, len(data), 4096):
+        r.put(data[i:i+4096])
+    n = 0
+    for l in r.lines():
+        n += len(l)
+    elapsed = time.time() - start
+    assert n == len(data) - len(data) // linelen
+    return elapsed * 1e9 / len(data)
+
+
+def main():
+    print '%10s %8s %10s' % ('burst', 'linelen', 'ns/byte')
+    for linelen in (80, 4096):
+        for burst in (1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24):
+            print '%10d %8d %10.2f' % (burst, linelen, run(burst, linelen))
+
+
+if __name__ == '__main__':
+    main()
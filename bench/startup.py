@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Measure how long port and portsh take to get as far as their options.
+
+Both are run thousands of times a day by scripts, so everything they do
+before getting to work is overhead.  We time parsing a typical command
+line with a freshly compiled spec (the first Options in a process) and
+with a cached one, and then whole processes that parse their options and
+exit.
+"""
+import os, sys, time, subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import options, port, portsh
+
+TOP = os.path.join(os.path.dirname(__file__), '..')
+ARGS = {'port': ['-s', '115200', '/dev/ttyUSB0'],
+        'portsh': ['-s', '115200', '--stats', '/dev/ttyUSB0', 'uname']}
+
+
+def per_call(fn, n):
+    start = time.time()
+    for i in range(n):
+        fn()
+    return (time.time() - start) * 1e6 / n
+
+
+def parse_cold():
+    options._specs.clear()
+    options.Options(portsh.optspec).parse(ARGS['portsh'])
+
+
+def parse_warm():
+    options.Options(portsh.optspec).parse(ARGS['portsh'])
+
+
+def process(code, n):
+    start = time.time()
+    for i in range(n):
+        subprocess.check_call([sys.executable, '-c', code], cwd=TOP)
+    return (time.time() - start) * 1e3 / n
+
+
+def main():
+    print '%-32s %10s' % ('', 'us/call')
+    print '%-32s %10.1f' % ('Options+parse, new spec',
+                            per_call(parse_cold, 2000))
+    print '%-32s %10.1f' % ('Options+parse, cached spec',
+                            per_call(parse_warm, 20000))
+    print
+    print '%-32s %10s' % ('', 'ms/process')
+    print '%-32s %10.1f' % ('python', process('pass', 20))
+    for name in ('port', 'portsh'):
+        code = ('import options, %s; options.Options(%s.optspec).parse(%r)'
+                % (name, name, ARGS[name]))
+        print '%-32s %10.1f' % ('%s options' % name, process(code, 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -59,7 +59,7 @@ Options can be put in different groups. Options in the same group must be on
 consecutive lines. Groups are formed by inserting a line that begins with a
 space. The text on that line will be output after an empty line.
 """
-import sys, os, textwrap, getopt, re, struct
+import sys, os, getopt, re, struct
 
 class OptDict:
     """Dictionary that exposes keys as attributes.
@@ -126,48 +126,30 @@ def _tty_width():
     return xsize or 70
 
 
-class Options:
-    """Option parser.
-    When constructed, a string called an option spec must be given. It
-    specifies the synopsis and option flags and their description.  For more
-    information about option specs, see the docstring at the top of this file.
-
-    Two optional arguments specify an alternative parsing function and an
-    alternative behaviour on abort (after having output the usage string).
+class _Spec:
+    """An options spec, compiled for parsing and, later, for showing usage.
 
-    By default, the parser function is getopt.gnu_getopt, and the abort
-    behaviour is to exit the program.
+    Nothing here depends on the terminal, so one _Spec can be shared by
+    every Options made from the same spec string; see _compile().
     """
-    def __init__(self, optspec, optfunc=getopt.gnu_getopt,
-                 onabort=_default_onabort):
-        self.optspec = optspec
-        self._onabort = onabort
-        self.optfunc = optfunc
-        self._aliases = {}
-        self._shortopts = 'h?'
-        self._longopts = ['help', 'usage']
-        self._hasparms = {}
-        self._defaults = {}
-        self._usagestr = self._gen_usage()
-
-    def _gen_usage(self):
-        out = []
-        lines = self.optspec.strip().split('\n')
+    def __init__(self, optspec):
+        self.aliases = {}
+        self.shortopts = 'h?'
+        self.longopts = ['help', 'usage']
+        self.hasparms = {}
+        self.synopsis = []
+        self.rows = []  # (flags_nice, description), or (None, header text)
+        defaults = {}
+        lines = optspec.strip().split('\n')
         lines.reverse()
-        first_syn = True
         while lines:
             l = lines.pop()
             if l == '--': break
-            out.append('%s: %s\n' % (first_syn and 'usage' or '   or', l))
-            first_syn = False
-        out.append('\n')
-        last_was_option = False
+            self.synopsis.append(l)
         while lines:
             l = lines.pop()
             if l.startswith(' '):
-                out.append('%s%s\n' % (last_was_option and '\n' or '',
-                                       l.lstrip()))
-                last_was_option = False
+                self.rows.append((None, l.lstrip()))
             elif l:
                 (flags, extra) = l.split(' ', 1)
                 extra = extra.strip()
@@ -185,38 +167,108 @@ class Options:
                 flagl_nice = []
                 for _f in flagl:
                     f,dvi = _remove_negative_kv(_f, _intify(defval))
-                    self._aliases[f] = _remove_negative_k(flagl[0])
-                    self._hasparms[f] = has_parm
-                    self._defaults[f] = dvi
+                    self.aliases[f] = _remove_negative_k(flagl[0])
+                    self.hasparms[f] = has_parm
+                    defaults[f] = dvi
                     if f == '#':
-                        self._shortopts += '0123456789'
+                        self.shortopts += '0123456789'
                         flagl_nice.append('-#')
                     elif len(f) == 1:
-                        self._shortopts += f + (has_parm and ':' or '')
+                        self.shortopts += f + (has_parm and ':' or '')
                         flagl_nice.append('-' + f)
                     else:
                         f_nice = re.sub(r'\W', '_', f)
-                        self._aliases[f_nice] = _remove_negative_k(flagl[0])
-                        self._longopts.append(f + (has_parm and '=' or ''))
-                        self._longopts.append('no-' + f)
+                        self.aliases[f_nice] = _remove_negative_k(flagl[0])
+                        self.longopts.append(f + (has_parm and '=' or ''))
+                        self.longopts.append('no-' + f)
                         flagl_nice.append('--' + _f)
                 flags_nice = ', '.join(flagl_nice)
                 if has_parm:
                     flags_nice += ' ...'
+                self.rows.append((flags_nice, extra))
+            else:
+                self.rows.append((None, ''))
+
+        # What parse() returns before looking at any flags, and which
+        # aliases to update when a flag sets an option.
+        opt = OptDict()
+        for k,v in defaults.iteritems():
+            opt[self.aliases[k]] = v
+        self.copies = {}
+        for (f1,f2) in self.aliases.iteritems():
+            opt[f1] = opt._opts.get(f2)
+            if f1 != f2:
+                self.copies.setdefault(f2, []).append(f1)
+        self.initial = opt._opts
+
+    def usage(self, width):
+        import textwrap  # takes longer to load than parsing does
+        out = []
+        first_syn = True
+        for l in self.synopsis:
+            out.append('%s: %s\n' % (first_syn and 'usage' or '   or', l))
+            first_syn = False
+        out.append('\n')
+        last_was_option = False
+        for flags_nice, extra in self.rows:
+            if flags_nice is not None:
                 prefix = '    %-20s  ' % flags_nice
-                argtext = '\n'.join(textwrap.wrap(extra, width=_tty_width(),
+                argtext = '\n'.join(textwrap.wrap(extra, width=width,
                                                 initial_indent=prefix,
                                                 subsequent_indent=' '*28))
                 out.append(argtext + '\n')
                 last_was_option = True
+            elif extra:
+                out.append('%s%s\n' % (last_was_option and '\n' or '', extra))
+                last_was_option = False
             else:
                 out.append('\n')
                 last_was_option = False
         return ''.join(out).rstrip() + '\n'
 
+
+_specs = {}
+
+def _compile(optspec):
+    """Return the _Spec for optspec, compiling it only the first time."""
+    spec = _specs.get(optspec)
+    if spec is None:
+        spec = _specs[optspec] = _Spec(optspec)
+    return spec
+
+
+class Options:
+    """Option parser.
+    When constructed, a string called an option spec must be given. It
+    specifies the synopsis and option flags and their description.  For more
+    information about option specs, see the docstring at the top of this file.
+
+    Two optional arguments specify an alternative parsing function and an
+    alternative behaviour on abort (after having output the usage string).
+
+    By default, the parser function is getopt.gnu_getopt, and the abort
+    behaviour is to exit the program.
+
+    The spec is compiled once per process, and the usage string is only
+    put together if it's needed.
+    """
+    def __init__(self, optspec, optfunc=getopt.gnu_getopt,
+                 onabort=_default_onabort):
+        self.optspec = optspec
+        self._onabort = onabort
+        self.optfunc = optfunc
+        self._spec = _compile(optspec)
+        self._aliases = self._spec.aliases
+        self._shortopts = self._spec.shortopts
+        self._longopts = self._spec.longopts
+        self._hasparms = self._spec.hasparms
+
+    def _gen_usage(self):
+        return self._spec.usage(_tty_width())
+
     def usage(self, msg=""):
         """Print usage string to stderr and abort."""
-        sys.stderr.write(self._usagestr)
+        sys.stderr.write(self._gen_usage())
         if msg:
             sys.stderr.write(msg)
         e = self._onabort and self._onabort(msg) or None
@@ -241,10 +293,8 @@ class Options:
             self.fatal(e)
 
         opt = OptDict()
-
-        for k,v in self._defaults.iteritems():
-            k = self._aliases[k]
-            opt[k] = v
+        opt._opts = dict(self._spec.initial)
+        copies = self._spec.copies
 
         for (k,v) in flags:
             k = k.lstrip('-')
@@ -266,6 +316,6 @@ class Options:
                 else:
                     v = _intify(v)
             opt[k] = v
-        for (f1,f2) in self._aliases.iteritems():
-            opt[f1] = opt._opts.get(f2)
+            for f1 in copies.get(k, ()):
+                opt[f1] = v
         return (opt,flags,extra)
@@ -27,22 +27,44 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import array
+import collections
 import errno
 import fcntl
+import mmap
 import os
-import random
+import re
 import select
+import signal
+import socket
+import struct
 import sys
+import tempfile
 import termios
 import time
 import tty
+import types
 import options
 
 optspec = """
 port [options...] <tty>
+port [options...] <tty> <input >output
+port [options...] --serve <tty...>
+port [options...] --replay=<log>
 --
 s,speed=    the baud rate to use [115200]
+wait=       if the tty is locked, wait up to this many seconds for it [0]
+profile=    tune for 'interactive' latency or 'bulk' throughput [interactive]
 l,limit=    maximum upload rate (for devices with crappy flow control) [9600]
+b,burst=    bytes to send at full speed before --limit kicks in [256]
+serve       share the ttys with any number of clients, which run port too
+tcp=        with --serve, also listen on TCP ports starting at this one
+bind=       with --tcp, the address to listen on [127.0.0.1]
+queue=      with --serve, output to buffer for each slow client [65536]
+watch       just watch a tty shared by --serve, without typing into it
+record=     append everything to this session log, for --replay
+replay=     print the tty output from this session log
+at=         with --replay, start this many seconds into the log
+grep=       with --replay, print just the lines matching this regex
 """
 
 
@@ -56,12 +78,25 @@ def log(s, *args):
     sys.stderr.flush()
 
 
+# How Modem.set_profile() can tune a tty.
+PROFILES = ('interactive', 'bulk')
+ASYNC_LOW_LATENCY = 1 << 13  # serial_struct.flags bit, from linux/tty_flags.h
+BULK_VMIN = 255  # cc_t is a byte, so this is the biggest batch we can ask for
+BULK_VTIME = 1  # deciseconds of silence that end a batch early
+
+
 class ModemError(Exception):
     pass
 
 class AlreadyLockedError(Exception):
     pass
 
+class Return(Exception):
+    """Raised by a coroutine to hand a value back to its caller; see Loop."""
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
 
 def _speedv(speed):
     try:
@@ -81,9 +116,20 @@ def _unlink(path):
 
 
 class Lock(object):
-    """Represents a unix tty lockfile to prevent overlapping access."""
+    """Represents a unix tty lockfile to prevent overlapping access.
 
-    def __init__(self, devname):
+    The lockfile is the usual UUCP one holding our pid, so other programs
+    can see the tty is busy.  We also flock() it: other copies of us then
+    sleep in the kernel until it's free instead of polling, and the lock
+    goes away by itself if we die.  If the tty is busy, wait up to timeout
+    seconds (forever if None) before raising AlreadyLockedError.
+
+    A lockfile someone else created can still be flock()ed read-only; if
+    it turns out to be stale and we can't replace it, we hold it without
+    putting our pid in it.
+    """
+
+    def __init__(self, devname, timeout=0):
         assert '/' not in devname
         if os.path.exists('/var/lock'):
             # Linux standard location
@@ -91,7 +137,8 @@ class Lock(object):
         else:
             # this is the patch minicom seems to use on MacOS X
             self.path = '/tmp/LCK..%s' % devname
-        self.lock()
+        self.fd = None
+        self.lock(timeout)
 
     def __del__(self):
         self.unlock()
@@ -104,7 +151,7 @@ class Lock(object):
                 return None  # not locked
             else:
                 return 0  # invalid lock
-        except ValueError:
+        except (ValueError, IndexError):
             return 0
 
     def _pid_exists(self, pid):
@@ -119,52 +166,117 @@ class Lock(object):
             raise  # any other error is weird, pass it on
         return True  # no error means it exists
 
-    def _try_lock(self):
-        try:
-            fd = os.open(self.path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
-        except OSError:
-            return
+    def _flock(self, fd, timeout):
+        """flock() fd, waiting up to timeout seconds; True if we got it."""
+        if timeout is not None and timeout <= 0:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+        # A blocking flock() wakes up the moment the holder lets go, and
+        # an alarm gets us out of it if that takes too long.
+        old = signal.signal(signal.SIGALRM, lambda sig, frame: None)
         try:
-            os.write(fd, '%s\n' % os.getpid())
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                return True
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                return False
         finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old)
+
+    def _open(self):
+        """Return (fd, writable) for the lockfile, creating it if need be."""
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        except OSError, e:
+            if e.errno != errno.EACCES:
+                raise
+        else:
+            try:
+                os.fchmod(fd, 0666)  # whatever our umask, let others in
+            except OSError:
+                pass  # not ours, but its owner lets us write it anyway
+            return fd, True
+        try:
+            return os.open(self.path, os.O_RDONLY), False
+        except OSError, e:
+            if e.errno != errno.EACCES:
+                raise
+            raise AlreadyLockedError('%r: %s' % (self.path, e.strerror))
+
+    def lock(self, timeout=0):
+        if self.fd is not None:
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        while 1:
+            fd, writable = self._open()
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            left = None if deadline is None else deadline - time.time()
+            if not self._flock(fd, left):
+                os.close(fd)
+                raise AlreadyLockedError('%r locked by pid %s'
+                                         % (self.path, self.read()))
+            try:
+                same = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                same = False
+            if same:
+                # programs that don't use flock() just leave their pid
+                # behind.  If they died, the file is stale and now ours.
+                pid = self.read()
+                if pid and pid != os.getpid() and self._pid_exists(pid):
+                    os.close(fd)
+                    raise AlreadyLockedError('%r locked by pid %d'
+                                             % (self.path, pid))
+                if writable or not self._remove():
+                    break
+                # someone else's stale file is gone; make one of our own.
+            # the holder deleted the file as it let go, so nobody else
+            # will ever look at the one we locked.  Try the new one.
             os.close(fd)
+        if writable:
+            os.ftruncate(fd, 0)
+            os.write(fd, '%s\n' % os.getpid())
+        self.fd = fd
 
-    def lock(self):
-        mypid = os.getpid()
-        for _ in range(10):
-            pid = self.read()
-            if pid == mypid:
-                return
-            elif pid is None:
-                # file did not exist
-                self._try_lock()
-            elif pid > 0 and self._pid_exists(pid):
-                raise AlreadyLockedError('%r locked by pid %d'
-                                         % (self.path, pid))
-            else:
-                # the lock owner died or didn't write a pid.  Cleaning it
-                # creates a race condition.  Delete it only after
-                # double checking.
-                time.sleep(0.2 + 0.2*random.random())
-                pid2 = self.read()
-                if pid2 == pid and (pid == 0 or not self._pid_exists(pid)):
-                    _unlink(self.path)
-                # now loop and try again.  Someone else might be racing with
-                # us, so there's no guarantee we'll get the lock on our
-                # next try.
-        raise AlreadyLockedError('%r lock contention detected' % self.path)
+    def _remove(self):
+        """Delete the lockfile; False if it's not ours to delete."""
+        try:
+            _unlink(self.path)
+        except OSError, e:
+            if e.errno not in (errno.EPERM, errno.EACCES):
+                raise
+            return False
+        return True
 
     def unlock(self):
-        if self.read() == os.getpid():
-            _unlink(self.path)
+        if self.fd is not None:
+            # delete it while we still hold it, so nobody can sneak in
+            # between; lock() notices and retries if it loses that race.
+            self._remove()
+            os.close(self.fd)
+            self.fd = None
 
 
 class Modem(object):
-    def __init__(self, filename, speed):
+    def __init__(self, filename, speed, wait=0, profile='interactive'):
         self.fd = self.tc_orig = None
+        self.serial_orig = self.latency_orig = None
+        self.speed = int(speed)
         if '/' not in filename and os.path.exists('/dev/%s' % filename):
             filename = '/dev/%s' % filename
-        self.lock = Lock(os.path.basename(filename))
+        self.lock = Lock(os.path.basename(filename), wait)
         self.fd = os.open(filename, os.O_RDWR | os.O_NONBLOCK)
         fcntl.fcntl(self.fd, fcntl.F_SETFL,
                     fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
@@ -174,17 +286,106 @@ class Modem(object):
         tc[2] |= termios.CLOCAL
         termios.tcsetattr(self.fd, termios.TCSADRAIN, tc)
         tty.setraw(self.fd)
+        self.latency_path = ('/sys/class/tty/%s/device/latency_timer'
+                             % os.path.basename(os.path.realpath(filename)))
+        self.set_profile(profile)
 
     def __del__(self):
         self.close()
 
+    def set_speed(self, speed):
+        """Switch to a new baud rate, after sending what's queued."""
+        tc = termios.tcgetattr(self.fd)
+        tc[4] = tc[5] = _speedv(speed)
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, tc)
+        self.speed = int(speed)
+
+    def set_profile(self, profile):
+        """Tune the tty for 'interactive' or 'bulk' use; see PROFILES.
+
+        interactive hands us every byte as soon as it arrives, and asks the
+        driver not to sit on input either.  bulk lets each read() gather
+        up to BULK_VMIN bytes, trading a little latency for far fewer
+        wakeups, and uses RTS/CTS flow control if the other end is driving
+        CTS (if it isn't, turning it on would stop us sending at all).
+        """
+        if profile not in PROFILES:
+            raise ModemError('invalid tty profile: %r (try %s)'
+                             % (profile, ' or '.join(PROFILES)))
+        tc = termios.tcgetattr(self.fd)
+        if profile == 'bulk':
+            tc[6][termios.VMIN] = BULK_VMIN
+            tc[6][termios.VTIME] = BULK_VTIME
+            if self._cts():
+                tc[2] |= termios.CRTSCTS
+        else:
+            tc[6][termios.VMIN] = 1
+            tc[6][termios.VTIME] = 0
+            tc[2] &= ~termios.CRTSCTS
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, tc)
+        self._low_latency(profile == 'interactive')
+        self.profile = profile
+
+    def _cts(self):
+        tbuf = array.array('i', [0])
+        try:
+            fcntl.ioctl(self.fd, termios.TIOCMGET, tbuf, True)
+        except IOError:
+            return False  # no modem lines at all, eg. a pty
+        return bool(tbuf[0] & termios.TIOCM_CTS)
+
+    def _serial_flags(self, flags=None):
+        """Return the driver's serial_struct.flags, after setting them."""
+        sbuf = array.array('i', [0] * 32)  # bigger than any serial_struct
+        try:
+            fcntl.ioctl(self.fd, termios.TIOCGSERIAL, sbuf, True)
+            if flags is not None and flags != sbuf[4]:
+                sbuf[4] = flags
+                fcntl.ioctl(self.fd, termios.TIOCSSERIAL, sbuf, True)
+        except (IOError, AttributeError):
+            return None  # not a serial driver, or not Linux
+        return sbuf[4]
+
+    def _low_latency(self, on):
+        """Ask the driver to pass input along with no delay, or stop asking.
+
+        Besides ASYNC_LOW_LATENCY, USB serial adapters like FTDI's hold
+        input for their latency_timer (16ms by default), which dwarfs
+        everything else, so we turn that down to 1ms.  close() puts both
+        back the way they were.
+        """
+        flags = self._serial_flags()
+        if flags is not None:
+            if self.serial_orig is None:
+                self.serial_orig = flags
+            if on:
+                self._serial_flags(flags | ASYNC_LOW_LATENCY)
+            else:
+                self._serial_flags(self.serial_orig)
+        try:
+            if self.latency_orig is None:
+                self.latency_orig = open(self.latency_path).read().strip()
+            open(self.latency_path, 'w').write(on and '1' or
+                                               self.latency_orig)
+        except IOError:
+            pass  # not a USB serial adapter, or we can't change it
+
     def close(self):
         if self.fd is not None:
+            if self.serial_orig is not None:
+                self._serial_flags(self.serial_orig)
+            if self.latency_orig is not None:
+                try:
+                    open(self.latency_path, 'w').write(self.latency_orig)
+                except IOError:
+                    pass
             try:
                 termios.tcsetattr(self.fd, termios.TCSADRAIN, self.tc_orig)
             except:
                 pass
             os.close(self.fd)
+            self.fd = None
+            self.lock.unlock()
 
     def flags(self):
         bits = [(i, getattr(termios,i))
@@ -202,9 +403,694 @@ class Modem(object):
         termios.tcsendbreak(self.fd, 0)
 
 
+class EscapeScanner(object):
+    """Finds ~. !. ~b ~s and ~r escapes at the start of lines on stdin.
+
+    Input arrives in arbitrary chunks, so an escape may be split across
+    them; we remember just enough of the current line to notice.
+    """
+    _escape_re = re.compile(r'[\r\n\x03](?:~[.bsr]|!\.)')
+
+    def __init__(self):
+        self.tail = '\n'  # pretend stdin starts on a fresh line
+
+    def scan(self, buf):
+        """Split buf into a list of (data, escape) pairs.
+
+        data should go to the modem as-is, followed by acting on escape,
+        which is '.', 'b', 's', 'r', or None.  The leading ~ or ! of an
+        escape is passed through, and any data after a '.' should be
+        dropped.
+        """
+        out = []
+        s = self.tail + buf
+        skip = len(self.tail)  # these were already passed through
+        while 1:
+            g = self._escape_re.search(s, skip - 2 if skip >= 2 else 0)
+            if not g:
+                break
+            esc = s[g.end() - 1]
+            out.append((s[skip:g.end() - 1], esc))
+            if esc == '.':
+                self.tail = '\n'
+                return out
+            # anything else resets the line, just like a newline would
+            s = '\n' + s[g.end():]
+            skip = 1
+        out.append((s[skip:], None))
+        self.tail = s[-2:]
+        return out
+
+
+class Pacer(object):
+    """Paces uploads for devices with crappy flow control.
+
+    A token bucket lets bursts of up to `burst` bytes (think interactive
+    typing) go out immediately, and refills at up to `limit` bps for
+    anything longer.  The kernel's output queue (TIOCOUTQ) tells us when
+    the UART isn't keeping up, say because the device is holding CTS: if
+    nothing in it goes out for as long as it should take to empty at the
+    limit, we halve the rate, and creep back up once the queue drains.
+    """
+
+    def __init__(self, fd, limit, burst):
+        self.fd = fd
+        self.max_rate = self.rate = limit / 10.0  # 10 bits per byte
+        self.min_rate = 30.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = self.moved = time.time()
+        self.last_q = 0  # the queue right after our last write
+
+    def outq(self):
+        """Return the number of bytes the kernel hasn't transmitted yet."""
+        tbuf = array.array('i', [0])
+        try:
+            fcntl.ioctl(self.fd, termios.TIOCOUTQ, tbuf, True)
+        except IOError:
+            return 0
+        return tbuf[0]
+
+    def allow(self, want):
+        """Return how many of want bytes may be written right now."""
+        now = time.time()
+        q = self.outq()
+        if q and q >= self.last_q:
+            if now - self.moved >= q / self.max_rate:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.moved = now
+        else:
+            self.moved = now
+            if not q and self.tokens < 1:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 16)
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        n = max(0, min(want, int(self.tokens), self.burst - q))
+        self.tokens -= n
+        self.last_q = q + n
+        return n
+
+    def delay(self):
+        """Return how long to wait before calling allow() again."""
+        # Waking up for every single byte would be silly; wait for ~10ms.
+        return max(0.01, (1 - self.tokens) / self.rate)
+
+
+def server_path(filename, readonly=False):
+    """Return the unix socket a console server shares tty filename on."""
+    return os.path.join(tempfile.gettempdir(),
+                        'port.%s%s' % (os.path.basename(filename),
+                                       readonly and '.ro' or ''))
+
+
+class Attached(object):
+    """Stands in for a Modem when we're a client of a console server."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.fd = self.sock.fileno()
+
+    def flags(self):
+        return 'shared by the server at %s' % self.path
+
+    def sendbreak(self):
+        log('(BREAK only works on the server)')
+
+
+class _Client(object):
+    """A socket attached to a console, with a bounded output queue.
+
+    If the client reads slower than the tty talks, the oldest output is
+    dropped rather than letting it hold up everyone else.
+    """
+
+    def __init__(self, sock, console, writable, limit):
+        self.sock = sock
+        self.console = console
+        self.writable = writable
+        self.limit = limit
+        self.queue = collections.deque()
+        self.queued = self.dropped = 0
+        sock.setblocking(False)
+
+    def put(self, data):
+        self.queue.append(data)
+        self.queued += len(data)
+        while self.queued > self.limit:
+            self.dropped += len(self.queue[0])
+            self.queued -= len(self.queue.popleft())
+
+    def flush(self):
+        """Send what we can without blocking; return True if all was sent."""
+        if self.dropped:
+            self.queue.appendleft('\r\n(port: %d bytes dropped)\r\n'
+                                  % self.dropped)
+            self.queued += len(self.queue[0])
+            self.dropped = 0
+        while self.queue:
+            try:
+                n = self.sock.send(self.queue[0])
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self.queued -= n
+            if n < len(self.queue[0]):
+                self.queue[0] = self.queue[0][n:]
+                return False
+            self.queue.popleft()
+        return True
+
+
+class Server(object):
+    """Shares ttys with any number of socket clients from one epoll loop.
+
+    Each tty is read once, and what it says goes to all of its clients.
+    Anything read-write clients send goes to the tty; read-only clients
+    just watch.  Output for each client is queued up to limit bytes.
+    """
+
+    def __init__(self, limit=65536):
+        self.limit = limit
+        self.ep = select.epoll()
+        self.handlers = {}  # fd: (kind, object, extra)
+        self.clients = {}  # console: set of _Client
+
+    def add(self, modem, listeners):
+        """Serve modem on listeners, a list of (listening socket, writable)."""
+        self.clients[modem] = set()
+        self._register(modem.fd, 'modem', modem, None)
+        for sock, writable in listeners:
+            sock.setblocking(False)
+            self._register(sock.fileno(), 'listener', sock, (modem, writable))
+
+    def _register(self, fd, kind, obj, extra, events=select.EPOLLIN):
+        self.handlers[fd] = (kind, obj, extra)
+        self.ep.register(fd, events)
+
+    def _drop(self, client):
+        fd = client.sock.fileno()
+        self.ep.unregister(fd)
+        del self.handlers[fd]
+        self.clients[client.console].discard(client)
+        client.sock.close()
+
+    def _flush(self, client):
+        try:
+            done = client.flush()
+        except socket.error:
+            self._drop(client)
+            return
+        self.ep.modify(client.sock.fileno(),
+                       select.EPOLLIN | (not done and select.EPOLLOUT or 0))
+
+    def step(self, timeout=-1):
+        for fd, events in self.ep.poll(timeout):
+            if fd not in self.handlers:
+                continue  # dropped earlier in this round
+            kind, obj, extra = self.handlers[fd]
+            if kind == 'listener':
+                try:
+                    sock, addr = obj.accept()
+                except socket.error:
+                    continue
+                console, writable = extra
+                client = _Client(sock, console, writable, self.limit)
+                self.clients[console].add(client)
+                self._register(sock.fileno(), 'client', client, None)
+            elif kind == 'modem':
+                buf = os.read(fd, 4096)
+                for client in list(self.clients[obj]):
+                    client.put(buf)
+                    self._flush(client)
+            else:
+                if events & select.EPOLLOUT:
+                    self._flush(obj)
+                if events & (select.EPOLLIN | select.EPOLLHUP |
+                             select.EPOLLERR) and fd in self.handlers:
+                    try:
+                        buf = obj.sock.recv(4096)
+                    except socket.error:
+                        buf = ''
+                    if not buf:
+                        self._drop(obj)
+                    elif obj.writable:
+                        os.write(obj.console.fd, buf)
+
+    def run(self):
+        while 1:
+            self.step()
+
+
+def serve(filenames, speed, limit, tcp=None, wait=0,
+          profile='interactive', bind='127.0.0.1'):
+    """Share the ttys in filenames on unix sockets (and TCP) until killed.
+
+    With tcp, tty number i is also on TCP port tcp+2*i of address bind,
+    and read-only on the port after that.  Wait up to wait seconds for
+    each tty's lock.  The unix sockets get the tty's group and its owner
+    and group permissions, so they let in whoever could open it anyway.
+    """
+    server = Server(limit)
+    paths = []
+    # Let a plain kill clean up the sockets.
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    try:
+        for i, filename in enumerate(filenames):
+            modem = Modem(filename, speed, wait, profile)
+            st = os.fstat(modem.fd)
+            listeners = []
+            for readonly in (False, True):
+                path = server_path(filename, readonly)
+                _unlink(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.bind(path)
+                paths.append(path)
+                try:
+                    os.chown(path, -1, st.st_gid)
+                except OSError:
+                    pass  # not in the tty's group; it stays ours alone
+                os.chmod(path, st.st_mode & 0660)
+                listeners.append((sock, not readonly))
+                if tcp:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    sock.bind((bind, int(tcp) + 2 * i + readonly))
+                    listeners.append((sock, not readonly))
+            for sock, writable in listeners:
+                sock.listen(16)
+            server.add(modem, listeners)
+            log('(%s: %s)\n' % (filename, server_path(filename)))
+        server.run()
+    finally:
+        for path in paths:
+            _unlink(path)
+
+
+# A session log is LOG_MAGIC followed by records of LOG_RECORD (time,
+# direction, length) and then the data.  Every LOG_INDEX_EVERY bytes or so,
+# the .idx file next to it gets a LOG_INDEX (time, offset) entry pointing
+# at the next record, so readers can find any time without a full scan.
+LOG_MAGIC = 'PORTLOG1'
+LOG_RECORD = struct.Struct('>dBI')
+LOG_INDEX = struct.Struct('>dQ')
+LOG_INDEX_EVERY = 65536
+FROM_TTY, TO_TTY = 0, 1
+
+
+class Recorder(object):
+    """Appends everything read from and written to a tty to a session log."""
+
+    def __init__(self, path):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self.fd = os.open(path, flags, 0666)
+        self.ifd = os.open(path + '.idx', flags, 0666)
+        self.pos = os.fstat(self.fd).st_size
+        if not self.pos:
+            self.pos = os.write(self.fd, LOG_MAGIC)
+        self.indexed = -LOG_INDEX_EVERY
+
+    def write(self, direction, data):
+        if not data:
+            return
+        now = time.time()
+        if self.pos - self.indexed >= LOG_INDEX_EVERY:
+            os.write(self.ifd, LOG_INDEX.pack(now, self.pos))
+            self.indexed = self.pos
+        self.pos += os.write(self.fd, LOG_RECORD.pack(now, direction,
+                                                      len(data)) + data)
+
+
+class Recording(object):
+    """A session log written by Recorder, mapped into memory for reading."""
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(LOG_MAGIC)] != LOG_MAGIC:
+            raise ModemError('%r is not a port session log' % path)
+        try:
+            f = open(path + '.idx', 'rb')
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, mmap.error, ValueError):
+            self.index = ''  # missing or empty; we can still scan
+        self.nindex = len(self.index) // LOG_INDEX.size
+        self.start = 0
+        for t, direction, data, ofs in self.records(len(LOG_MAGIC)):
+            self.start = t
+            break
+
+    def _entry(self, i):
+        return LOG_INDEX.unpack_from(self.index, i * LOG_INDEX.size)
+
+    def _bisect(self, key, value):
+        """Return the offset of the last index entry whose key <= value."""
+        lo, hi = 0, self.nindex
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[key] <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo and self._entry(lo - 1)[1] or len(LOG_MAGIC)
+
+    def records(self, ofs):
+        """Yield (time, direction, data, offset) for records from ofs on."""
+        m = self.map
+        while ofs + LOG_RECORD.size <= len(m):
+            t, direction, n = LOG_RECORD.unpack_from(m, ofs)
+            data = m[ofs + LOG_RECORD.size:ofs + LOG_RECORD.size + n]
+            if len(data) < n:
+                break  # cut short by a crash, or still being written
+            yield t, direction, data, ofs
+            ofs += LOG_RECORD.size + n
+
+    def seek(self, t):
+        """Return the offset of the first record at or after time t."""
+        for rt, direction, data, ofs in self.records(self._bisect(0, t)):
+            if rt >= t:
+                return ofs
+        return len(self.map)
+
+    def grep(self, regex, pos=len(LOG_MAGIC)):
+        """Yield (time, direction, line) for lines matching regex.
+
+        The search starts at offset pos.  The regex runs over the raw
+        mapped file to find likely records quickly, then over each one's
+        data, so record headers can't get into a match (or spoil one).  A
+        match split across two records is missed.
+        """
+        r = re.compile(regex)
+        while 1:
+            g = r.search(self.map, pos)
+            if not g:
+                break
+            for t, direction, data, ofs in self.records(
+                    self._bisect(1, g.start())):
+                if ofs + LOG_RECORD.size + len(data) > g.start():
+                    break
+            else:
+                break  # only a record cut short is left
+            start = ofs + LOG_RECORD.size
+            i = max(0, pos - start)
+            while i <= len(data):
+                m = r.search(data, i)
+                if not m:
+                    break
+                first = data.rfind('\n', 0, m.start()) + 1
+                last = data.find('\n', m.start())
+                if last < 0:
+                    last = len(data)
+                yield t, direction, data[first:last]
+                i = last + 1  # one match per line
+            pos = start + len(data)
+
+
+def replay(path, at=None, regex=None):
+    """Print the tty output in the session log at path.
+
+    at is in seconds since the log started.  With regex, print just the
+    matching lines, each with its time.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)  # for | head, | less
+    rec = Recording(path)
+    pos = rec.seek(rec.start + (at or 0))
+    if regex:
+        for t, direction, line in rec.grep(regex, pos):
+            sys.stdout.write('%12.3f %s %s\n'
+                             % (t - rec.start,
+                                direction == TO_TTY and '>' or '<',
+                                line.rstrip('\r')))
+        return
+    out = []
+    for t, direction, data, ofs in rec.records(pos):
+        if direction == FROM_TTY:
+            out.append(data)
+            if len(out) >= 1024:
+                sys.stdout.write(''.join(out))
+                out = []
+    sys.stdout.write(''.join(out))
+
+
+class Task(object):
+    """A coroutine running in a Loop.
+
+    Once done is set, result holds what it passed to Return, or error holds
+    the sys.exc_info() of the exception that ended it.
+    """
+
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.rfds = []
+        self.deadline = None
+        self.done = False
+        self.result = self.error = None
+
+
+class Loop(object):
+    """Runs many coroutines, each as its own Task, from one select loop.
+
+    A coroutine is a generator.  It yields (rfds, timeout) to sleep until
+    one of the fds in rfds is readable or timeout seconds have passed
+    (None waits forever), and gets back the list of readable fds, which is
+    empty after a timeout.  Yielding another generator calls it as a
+    coroutine: its Return value, or None, comes back as the result of the
+    yield, and its exceptions are raised there.
+
+    That lets one process drive any number of ttys, each with code that
+    reads as if it had the process to itself.  Writes still block, which
+    is fine as long as the tty keeps up with us.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        """Start coroutine as a new Task, and return the Task."""
+        task = Task(coroutine)
+        self.tasks.append(task)
+        self._resume(task, None)
+        return task
+
+    def _resume(self, task, value):
+        error = None
+        while task.stack:
+            gen = task.stack[-1]
+            try:
+                if error:
+                    e, error = error, None
+                    got = gen.throw(*e)
+                else:
+                    got = gen.send(value)
+            except Return, e:
+                task.stack.pop()
+                value = e.value
+                continue
+            except StopIteration:
+                task.stack.pop()
+                value = None
+                continue
+            except Exception:
+                task.stack.pop()
+                error = sys.exc_info()
+                continue
+            if isinstance(got, types.GeneratorType):
+                task.stack.append(got)
+                value = None
+            else:
+                task.rfds, timeout = got
+                task.deadline = None
+                if timeout is not None:
+                    task.deadline = time.time() + timeout
+                return
+        task.done = True
+        task.result = value
+        task.error = error
+
+    def step(self):
+        """Wait for the next event, and resume the tasks it concerns."""
+        live = self.tasks = [task for task in self.tasks if not task.done]
+        rl = set()
+        timeout = None
+        now = time.time()
+        for task in live:
+            rl.update(task.rfds)
+            if task.deadline is not None:
+                left = max(0, task.deadline - now)
+                if timeout is None or left < timeout:
+                    timeout = left
+        r,w,x = select.select(list(rl), [], [], timeout)
+        now = time.time()
+        for task in live:
+            ready = [fd for fd in task.rfds if fd in r]
+            if ready or (task.deadline is not None and task.deadline <= now):
+                self._resume(task, ready)
+
+    def run(self):
+        """Run until all tasks are done."""
+        while [task for task in self.tasks if not task.done]:
+            self.step()
+
+    def call(self, coroutine):
+        """Run coroutine (and any other tasks) until it's done.
+
+        Returns its result, or raises the exception it ended with.
+        """
+        task = self.spawn(coroutine)
+        while not task.done:
+            self.step()
+        if task.error:
+            raise task.error[0], task.error[1], task.error[2]
+        return task.result
+
+
+def transfer(modem, esc, tc_stdin_orig):
+    """Handle ~s or ~r: ask what to send or receive, and do it.
+
+    The transfer runs at full speed, ignoring --limit; the protocols have
+    their own flow control and error checking.  Typing ^C or ^X stops it.
+    """
+    import xfer
+    if esc == 's':
+        prompt = 'send with z, y, x or x1k, then files'
+    else:
+        prompt = 'receive with z or y into a directory, or x into a file'
+    termios.tcsetattr(0, termios.TCSANOW, tc_stdin_orig)
+    try:
+        log('\n(%s): ', prompt)
+        words = os.read(0, 4096).split()
+    finally:
+        tty.setraw(0)
+    if not words:
+        return
+    proto, args = words[0], words[1:]
+    link = xfer.Link(modem.fd, abort_fd=0)
+    try:
+        if esc == 's' and proto == 'z' and args:
+            xfer.send_zmodem(link, args, log)
+        elif esc == 's' and proto == 'y' and args:
+            xfer.send_ymodem(link, args, log)
+        elif esc == 's' and proto in ('x', 'x1k') and len(args) == 1:
+            xfer.send_xmodem(link, args[0], log, onek=(proto == 'x1k'))
+        elif esc == 'r' and proto == 'z' and len(args) <= 1:
+            xfer.receive_zmodem(link, args and args[0] or '.', log)
+        elif esc == 'r' and proto == 'y' and len(args) <= 1:
+            xfer.receive_ymodem(link, args and args[0] or '.', log)
+        elif esc == 'r' and proto == 'x' and len(args) == 1:
+            xfer.receive_xmodem(link, args[0], log)
+        else:
+            log('(huh? %s)\n', prompt)
+    except (xfer.TransferError, IOError, OSError), e:
+        link.cancel()
+        log('\n(transfer failed: %s)\n', e)
+
+
+PIPE_CHUNK = 65536  # biggest read from either side in pipe()
+PIPE_BUFFER = 4 << 20  # stop reading the tty if stdout is this far behind
+
+
+def pipe(modem, pacer=None, recorder=None):
+    """Copy stdin to the tty and the tty to stdout, for use in a pipeline.
+
+    There's no terminal to set up or escapes to watch for, so this just
+    moves data in big chunks.  Output the reader isn't ready for piles up
+    and goes out in one write() as soon as it is; if it falls more than
+    PIPE_BUFFER behind, we stop reading the tty, which with RTS/CTS (see
+    --profile=bulk) holds off the sender rather than losing anything.
+    Runs until the tty goes away, stdout is closed, or we're killed.
+    """
+    out = []  # from the tty, not yet written
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    try:
+        _pipe_loop(modem, pacer, recorder, out)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    # We're on our way out already; don't let a second kill (timeout(1)
+    # sends two) interrupt the cleanup.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        os.write(1, ''.join(out))
+    except OSError, e:
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def _pipe_loop(modem, pacer, recorder, out):
+    todo = ''  # from stdin, not yet sent
+    nout = 0
+    stdin_eof = False
+    while 1:
+        timeout = None
+        if todo:
+            n = len(todo)
+            if pacer:
+                n = pacer.allow(n)
+            if n:
+                n = os.write(modem.fd, todo[:n])
+                if recorder:
+                    recorder.write(TO_TTY, todo[:n])
+                todo = todo[n:]
+            if todo:
+                timeout = pacer and pacer.delay() or 0.01
+        rfds = []
+        if not todo and not stdin_eof:
+            rfds.append(0)
+        if nout < PIPE_BUFFER:
+            rfds.append(modem.fd)
+        r, w, x = select.select(rfds, out and [1] or [], [], timeout)
+        if 1 in w:
+            buf = ''.join(out)
+            try:
+                n = os.write(1, buf)
+            except OSError, e:
+                if e.errno == errno.EPIPE:
+                    del out[:]
+                    return
+                raise
+            out[:] = n < len(buf) and [buf[n:]] or []
+            nout = len(buf) - n
+        if 0 in r:
+            todo = os.read(0, PIPE_CHUNK)
+            if not todo:
+                stdin_eof = True
+        if modem.fd in r:
+            try:
+                buf = os.read(modem.fd, PIPE_CHUNK)
+            except OSError, e:
+                if e.errno != errno.EIO:  # the tty hung up
+                    raise
+                buf = ''
+            if not buf:
+                return
+            out.append(buf)
+            nout += len(buf)
+            if recorder:
+                recorder.write(FROM_TTY, buf)
+
+
 def main():
     o = options.Options(optspec)
     (opt, flags, extra) = o.parse(sys.argv[1:])
+    try:
+        wait = float(opt.wait or 0)
+    except ValueError:
+        o.fatal('--wait expects a number of seconds')
+    if opt.profile not in PROFILES:
+        o.fatal('--profile should be one of: %s' % ', '.join(PROFILES))
+    if opt.replay:
+        if extra:
+            o.fatal("no tty name expected with --replay")
+        replay(opt.replay, opt.at and float(opt.at), opt.grep)
+        return
+    if opt.serve:
+        if not extra:
+            o.fatal("at least one tty name expected")
+        serve(extra, opt.speed, int(opt.queue), opt.tcp, wait,
+              opt.profile, opt.bind)
+        return
     if len(extra) != 1:
         o.fatal("exactly one tty name expected")
     filename = extra[0]
@@ -213,21 +1099,39 @@ def main():
     if opt.limit > max(115200, int(opt.speed)):
         o.fatal('--limit should be no more than --speed')
 
-    tc_stdin_orig = termios.tcgetattr(0)
-    modem = Modem(filename, opt.speed)
+    path = server_path(filename, opt.watch)
+    modem = None
+    if os.path.exists(path):
+        try:
+            modem = Attached(path)
+        except socket.error, e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                o.fatal('%s: %s' % (path, e.strerror))
+            # else left behind by a server that was killed, or just gone
+    if not modem:
+        if opt.watch:
+            o.fatal('--watch needs a port --serve for %s' % filename)
+        modem = Modem(filename, opt.speed, wait, opt.profile)
 
-    line = ''
-    MAGIC = ['~.', '!.']
+    recorder = opt.record and Recorder(opt.record)
+    scanner = EscapeScanner()
+    pacer = None
+    if opt.limit:
+        pacer = Pacer(modem.fd, opt.limit, opt.burst)
+    if not os.isatty(0) or not os.isatty(1):
+        pipe(modem, pacer, recorder)
+        return
+
+    tc_stdin_orig = termios.tcgetattr(0)
+    todo = []  # (data, escape) pairs from the scanner, not yet sent
+    stdin_eof = False
 
     try:
         tty.setraw(0)
 
         mflags = None
-        last_out = 0
-        if opt.limit:
-            secs_per_byte = 1.0 / (float(opt.limit) / 10)
-            assert(secs_per_byte < 0.1)
-        log('(Type ~. or !. to exit, or ~b to send BREAK)')
+        log('(Type ~. or !. to exit, ~b to send BREAK, '
+            'or ~s or ~r to send or receive files)')
 
         while 1:
             newflags = modem.flags()
@@ -235,27 +1139,54 @@ def main():
                 mflags = newflags
                 log('\n(Line Status: %s)\n', mflags)
 
-            r,w,x = select.select([0,modem.fd], [], [])
-            if 0 in r:
-                buf = os.read(0, 1)
-                if buf in '\r\n\x03':
-                    line = ''
-                else:
-                    line += buf
-                if line in MAGIC:
+            timeout = None
+            while todo:
+                data, esc = todo[0]
+                n = len(data)
+                if pacer:
+                    n = pacer.allow(n)
+                if n:
+                    os.write(modem.fd, data[:n])
+                    if recorder:
+                        recorder.write(TO_TTY, data[:n])
+                if n < len(data):
+                    todo[0] = (data[n:], esc)
+                    timeout = pacer.delay()
                     break
-                if line == '~b':
+                todo.pop(0)
+                if esc == '.':
+                    return
+                elif esc == 'b':
                     log('(BREAK)')
                     modem.sendbreak()
-                    line = ''
-                elif len(buf):
-                    os.write(modem.fd, buf)
-                    if opt.limit:
-                        time.sleep(secs_per_byte)
+                elif esc in ('s', 'r'):
+                    transfer(modem, esc, tc_stdin_orig)
+
+            # Don't read more from stdin until the pacer catches up.
+            fds = [modem.fd]
+            if not todo and not stdin_eof:
+                fds.append(0)
+            r,w,x = select.select(fds, [], [], timeout)
+            if 0 in r:
+                buf = os.read(0, 4096)
+                if not buf:
+                    stdin_eof = True
+                todo = scanner.scan(buf)
             if modem.fd in r:
-                buf = os.read(modem.fd, 4096)
-                if len(buf):
-                    os.write(1, buf)
+                try:
+                    buf = os.read(modem.fd, 4096)
+                except OSError, e:
+                    if e.errno != errno.EIO:  # the tty hung up
+                        raise
+                    buf = ''
+                if not buf:
+                    log('\n(port: %s went away)\n',
+                        isinstance(modem, Attached) and 'the server'
+                        or 'the tty')
+                    return
+                os.write(1, buf)
+                if recorder:
+                    recorder.write(FROM_TTY, buf)
                 if buf == '\0':
                     log('\n(received NUL byte)\n')
     finally:
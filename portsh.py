@@ -26,66 +26,813 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+# Lines from portsh to the remote go through the remote tty's canonical
+# line buffer, which only holds 4095 bytes.  Keep pushed frames small, and
+# few enough of them in flight, that a stalled remote can never overflow it.
+PUSH_FRAME, PUSH_WINDOW = 768, 3
+PULL_FRAME, PULL_WINDOW = 4096, 8
+FILE_CHUNK = 65536
+
+# Output and stdin are held back for up to HOLD_MS, or until there are
+# HOLD_BYTES of it, so chatty programs don't cost a line per write.
+# BULK_HOLD trades latency for fewer, bigger lines.  Upward lines also
+# have to fit the canonical line buffer, hence MAX_STDIN.
+HOLD_MS, HOLD_BYTES = 5, 1024
+BULK_HOLD = (50, 16384)
+MAX_STDIN = 1024
+
+# Neither end sends a command more stdin, or portsh more of its output,
+# than the other end has room for.  Each channel starts with a window of
+# credit, in payload bytes, and the receiver grants more with a G line as
+# it passes data on.  Stdin shares the canonical line buffer with pushes,
+# so its window is small.
+STDIN_WINDOW = 2 * MAX_STDIN
+OUTPUT_WINDOW = 65536
+
+# Every line after the handshake is a Framer frame.  Up to LINK_WINDOW of
+# them may be unacknowledged at once; acknowledgements wait up to
+# ACK_DELAY for company, and a frame is sent again if it isn't
+# acknowledged within LINK_TIMEOUT, plus the time it takes to send.
+# portsh gives up on a remote end it hasn't heard from in LINK_DEAD.
+LINK_WINDOW = 32
+ACK_DELAY = 0.05
+LINK_TIMEOUT = 1.0
+LINK_DEAD = 30
+
+# Control characters are never safe to send to a tty in canonical mode
+# (think ^C, ^D, ^U), so only probe the rest.  A link that strips the high
+# bit would turn 0x80-0x9f into control characters too, so those are only
+# trusted if 0xa0-0xff, which strip to harmless ones, make it through.
+# Newlines end the line, so they can't be probed in either direction.
+PROBE_UP = range(0x20, 0x7f) + range(0xa0, 0x100)
+PROBE_DOWN = range(0x0a) + range(0x0b, 0x100)
+
+# Sent both ways to check a new baud rate.  'U' is 01010101, which is the
+# quickest way to show up a bad bit clock.
+SHIFT_PATTERN = "U" * 16 + "".join(chr(v) for v in range(0x21, 0x7f))
+
+
+def _textcodec(spec):
+    """Return (encode, decode) functions for the wire encoding named by spec.
+
+    "b64" is base64, "b85" is Ascii85 (without the 'z' shortcut) and
+    "esc8:0a,0d,..." passes bytes through unchanged except for the listed
+    values, which are sent yEnc-style as '=' followed by the byte plus 64.
+    """
+    import re, struct
+    if spec == "b64":
+        return (lambda b: b.encode("base64").replace("\n", ""),
+                lambda s: s.decode("base64"))
+    elif spec == "b85":
+        # Lookup tables for pairs of digits make this tolerably fast.
+        pairs = [chr(33 + i // 85) + chr(33 + i % 85) for i in range(7225)]
+        values = dict((p, i) for i, p in enumerate(pairs))
+        def encode(b):
+            pad = -len(b) % 4
+            n = (len(b) + pad) // 4
+            out = "".join(chr(33 + w // 52200625) + pairs[w // 7225 % 7225] +
+                          pairs[w % 7225]
+                          for w in struct.unpack(">%dL" % n, b + "\0" * pad))
+            return out[:len(out) - pad]
+        def decode(s):
+            pad = -len(s) % 5
+            s += "u" * pad
+            words = [(ord(s[i]) - 33) * 52200625 + values[s[i+1:i+3]] * 7225 +
+                     values[s[i+3:i+5]] for i in range(0, len(s), 5)]
+            out = struct.pack(">%dL" % len(words), *words)
+            return out[:len(out) - pad]
+        return encode, decode
+    elif spec.startswith("esc8:"):
+        esc = [int(h, 16) for h in spec[5:].split(",")]
+        emap = dict((chr(v), "=" + chr((v + 64) & 0xff)) for v in esc)
+        dmap = dict((chr((v + 64) & 0xff), chr(v)) for v in esc)
+        er = re.compile("[%s]" % "".join("\\x%02x" % v for v in esc))
+        dr = re.compile("=(.)", re.DOTALL)
+        return (lambda b: er.sub(lambda m: emap[m.group()], b),
+                lambda s: dr.sub(lambda m: dmap[m.group(1)], s))
+    raise ValueError("unknown encoding %r" % spec)
+
+
+def _probe(values):
+    """Return a string exercising each byte value in a recognizable token."""
+    return "".join("%02x%c%02x" % (v, v, v) for v in values)
+
+
+def _mangled(line, values):
+    """Return the byte values whose _probe() tokens didn't survive in line."""
+    return [v for v in values if ("%02x%c%02x" % (v, v, v)) not in line]
+
+
+def _upshift(splitter, speeds):
+    """Remote half of upshift(): switch to the fastest of speeds we know.
+
+    We keep the new rate only if SHIFT_PATTERN makes it through both ways
+    and portsh confirms it; otherwise we go back to the old one.  Either
+    way, the rate we ended up with is reported at that rate.  Returns the
+    old rate's termios value if we switched, for _unshift().
+    """
+    import os, select, sys, termios, time
+    def readline(timeout):
+        if select.select([0], [], [], timeout)[0]:
+            return os.read(0, 8192).rstrip("\r\n")
+    old = termios.tcgetattr(0)
+    before = old[4]
+    known = [int(v) for v in speeds.split(",") if hasattr(termios, "B" + v)]
+    speed = max(known + [0])
+    print "%s-SHIFT %d" % (splitter, speed)
+    sys.stdout.flush()
+    if not speed:
+        return
+    tc = termios.tcgetattr(0)
+    tc[4] = tc[5] = getattr(termios, "B%d" % speed)
+    tc[0] &= ~termios.IXON  # line noise at the wrong rate mustn't stop us,
+    tc[3] &= ~termios.ISIG  # or kill us
+    termios.tcdrain(1)
+    termios.tcsetattr(0, termios.TCSANOW, tc)
+    termios.tcflush(0, termios.TCIFLUSH)
+    if readline(2) == SHIFT_PATTERN:
+        print SHIFT_PATTERN
+        sys.stdout.flush()
+        if readline(2) == "ok":
+            old[4] = old[5] = tc[4]
+    termios.tcsetattr(0, termios.TCSADRAIN, old)
+    if old[4] != tc[4]:
+        # Give portsh time to give up on the new rate too, so it can hear us.
+        speed = 0
+        time.sleep(1.5)
+        termios.tcflush(0, termios.TCIFLUSH)
+    print "%s-SHIFTED %d" % (splitter, speed)
+    if speed:
+        return before
+
+
+def _unshift(splitter, speed, rate):
+    """Go back to the speed we had before _upshift(), taking portsh along.
+
+    We tell portsh the rate at the fast one, switch, and wait for it to
+    answer at the slow one, so it hears whatever we say after this.
+    """
+    import os, select, sys, termios, time
+    print "%s-UNSHIFT %d" % (splitter, rate)
+    sys.stdout.flush()
+    termios.tcdrain(1)
+    tc = termios.tcgetattr(0)
+    tc[4] = tc[5] = speed
+    termios.tcsetattr(0, termios.TCSANOW, tc)
+    termios.tcflush(0, termios.TCIFLUSH)
+    deadline = time.time() + 2
+    buf = ""
+    while "\nok\n" not in "\n" + buf:
+        timeout = deadline - time.time()
+        if timeout <= 0 or not select.select([0], [], [], timeout)[0]:
+            break
+        got = os.read(0, 8192)
+        if not got:
+            break
+        buf = (buf + got.replace("\r", ""))[-64:]
+
+
+class Codec(object):
+    """zlib streams in each direction, carried as lines of encoded text.
+
+    Each payload starts with a tag saying how it was packed: "r" for raw,
+    "f" for the fast zlib stream or "z" for the thorough one.  Tiny chunks
+    and incompressible data go raw, since the sync flush and the deflate
+    block headers would only make them bigger; big compressible chunks get
+    the thorough stream.  Each stream keeps its own history.
+
+    Both directions start out as base64 until use() picks something denser.
+    sent and received count bytes of payload, after compression and after
+    encoding, in that order.
+    """
+
+    def __init__(self):
+        import zlib
+        self.zlib = zlib
+        self.zc = {"f": zlib.compressobj(1), "z": zlib.compressobj(9)}
+        self.zd = {"f": zlib.decompressobj(), "z": zlib.decompressobj()}
+        self.ratio = 0.5  # running estimate of compressed/raw size
+        self.skipped = 0
+        self.sent = [0, 0, 0]
+        self.received = [0, 0, 0]
+        self.use("b64", "b64")
+
+    def use(self, tx, rx):
+        """Switch the outgoing and incoming text encodings."""
+        self.tx = tx
+        self.rx = rx
+        self.enc = _textcodec(tx)[0]
+        self.dec = _textcodec(rx)[1]
+
+    def _count(self, counts, b, z, s):
+        counts[0] += len(b)
+        counts[1] += len(z)
+        counts[2] += len(s)
+
+    def pack(self, b):
+        """Return (tag, packed bytes) for b; see the class docstring."""
+        if len(b) < 16:
+            return "r", b
+        if self.ratio > 0.95 and self.skipped < 16:
+            # Probably more of the same incompressible stuff, but check
+            # every so often in case that changes.
+            self.skipped += 1
+            return "r", b
+        self.skipped = 0
+        tag = len(b) >= 1024 and self.ratio < 0.6 and "z" or "f"
+        # Try it on a copy, so we can back out if it doesn't pay off.
+        zc = self.zc[tag].copy()
+        z = zc.compress(b) + zc.flush(self.zlib.Z_SYNC_FLUSH)
+        self.ratio = 0.75 * self.ratio + 0.25 * len(z) / len(b)
+        if len(z) >= len(b):
+            return "r", b
+        self.zc[tag] = zc
+        return tag, z
+
+    def unpack(self, tag, z):
+        if tag == "r":
+            return z
+        return self.zd[tag].decompress(z)
+
+    def encode(self, b):
+        tag, z = self.pack(b)
+        s = tag + self.enc(z)
+        self._count(self.sent, b, z, s)
+        return s
+
+    def decode(self, s):
+        s = s.rstrip("\r\n")
+        z = self.dec(s[1:])
+        b = self.unpack(s[:1], z)
+        self._count(self.received, b, z, s)
+        return b
+
+    def frames(self, b, size):
+        """Pack b and split the result into encoded frames.
+
+        Each frame holds at most size bytes of packed data.  Compressed
+        streams continue across frames, so they must be decoded in order.
+        """
+        tag, z = self.pack(b)
+        frames = [tag + self.enc(z[i:i+size]) for i in range(0, len(z), size)]
+        self._count(self.sent, b, z, "".join(frames))
+        return frames
+
+
+class Framer(object):
+    """Sequence numbers, checksums and retransmission for lines of text.
+
+    Lines given to send() go out through write() as "@<seq> <crc> <line>",
+    and are kept until the other end acknowledges them with "@A <seq>
+    <crc>", meaning it has every line before seq.  A damaged frame, or a
+    gap in the sequence, is asked for again with "@N <seq> <crc>", and
+    the oldest frame goes out again if no acknowledgement comes within
+    rto() seconds.  got() returns the lines that arrived, intact and in
+    order, or None if it wasn't given a frame at all.
+
+    The other end must call got() and step() too, or nothing is ever
+    acknowledged.  bps, if known, is the speed of the line in bits per
+    second, to allow for the time frames spend in transit.
+    """
+
+    def __init__(self, write, bps=0):
+        import time, zlib
+        self.time = time.time
+        self.crc32 = zlib.crc32
+        self.write = write
+        self.bps = bps
+        self.tx = self.rx = self.acked = 0
+        self.unacked = {}  # seq: frame
+        self.queue = []
+        self.early = {}  # seq: line, for frames that arrived after a gap
+        self.ack_at = self.resend_at = None
+        self.nakked = (None, 0)
+        self.heard = self.time()
+        self.damaged = self.resent = 0
+
+    def _crc(self, s):
+        return "%08x" % (self.crc32(s) & 0xffffffff)
+
+    def _control(self, kind, seq):
+        s = "%s %d" % (kind, seq)
+        self.write("@%s %s" % (s, self._crc(s)))
+
+    def _nak(self, seq, again=False):
+        # Every frame after a gap points at it, but one request will do,
+        # unless the frame we asked for turns up damaged again.
+        now = self.time()
+        if (again or self.nakked[0] != seq or
+                now - self.nakked[1] > LINK_TIMEOUT):
+            self.nakked = (seq, now)
+            self._control("N", seq)
+
+    def rto(self):
+        nbytes = sum(len(f) for f in self.unacked.values())
+        return LINK_TIMEOUT + (self.bps and nbytes * 10.0 / self.bps or 0)
+
+    def send(self, line=None):
+        if line is not None:
+            self.queue.append(line)
+        while self.queue and len(self.unacked) < LINK_WINDOW:
+            if not self.unacked:
+                self.resend_at = self.time() + self.rto()
+            seq, line = self.tx, self.queue.pop(0)
+            self.tx += 1
+            frame = "@%d %s %s" % (seq, self._crc("%d %s" % (seq, line)), line)
+            self.unacked[seq] = frame
+            self.write(frame)
+
+    def got(self, line):
+        if not line.startswith("@"):
+            return None
+        words = line[1:].split(" ", 2)
+        if len(words) < 3:
+            ok = False
+        elif words[0] in ("A", "N"):
+            ok = (words[1].isdigit() and
+                  words[2] == self._crc("%s %s" % tuple(words[:2])))
+        else:
+            ok = (words[0].isdigit() and
+                  words[1] == self._crc("%s %s" % (words[0], words[2])))
+        if not ok:
+            self.damaged += 1
+            self._nak(self.rx, again=True)
+            return []
+        self.heard = self.time()
+        if words[0].isdigit():
+            kind, seq = None, int(words[0])
+        else:
+            kind, seq = words[0], int(words[1])
+        if kind == "A":
+            if [v for v in self.unacked if v < seq]:
+                for v in [v for v in self.unacked if v < seq]:
+                    del self.unacked[v]
+                self.resend_at = self.time() + self.rto()
+                self.send()
+            return []
+        elif kind == "N":
+            if seq in self.unacked:
+                self.resent += 1
+                self.write(self.unacked[seq])
+            return []
+        elif seq < self.rx:
+            self._control("A", self.rx)  # it was sent again; say we have it
+            return []
+        elif seq > self.rx:
+            if seq < self.rx + LINK_WINDOW:
+                self.early[seq] = words[2]
+            self._nak(self.rx)
+            return []
+        lines = [words[2]]
+        self.rx += 1
+        while self.rx in self.early:
+            lines.append(self.early.pop(self.rx))
+            self.rx += 1
+        if self.early:
+            self._nak(self.rx)
+        if self.ack_at is None:
+            self.ack_at = self.time() + ACK_DELAY
+        return lines
+
+    def timeout(self):
+        """Return how long until step() has something to do, or None."""
+        times = [t for t in (self.ack_at, self.unacked and self.resend_at)
+                 if t]
+        if times:
+            return max(0, min(times) - self.time())
+
+    def step(self):
+        now = self.time()
+        if self.ack_at is not None and (now >= self.ack_at or
+                                        self.rx - self.acked >=
+                                        LINK_WINDOW // 2):
+            self.ack_at = None
+            self.acked = self.rx
+            self._control("A", self.rx)
+        if self.unacked and now >= self.resend_at:
+            self.resent += 1
+            self.write(self.unacked[min(self.unacked)])
+            self.resend_at = now + self.rto()
+
+
+class Holder(object):
+    """Collects small chunks of data into bigger ones.
+
+    Data is held until there are size bytes of it, or until the oldest of
+    it has waited delay seconds.
+    """
+
+    def __init__(self, delay, size):
+        import time
+        self.time = time.time
+        self.delay = delay
+        self.size = size
+        self.buf = []
+        self.n = 0
+        self.since = None
+
+    def put(self, b):
+        if not self.buf:
+            self.since = self.time()
+        self.buf.append(b)
+        self.n += len(b)
+
+    def due(self):
+        return self.n and (self.n >= self.size or
+                           self.time() - self.since >= self.delay)
+
+    def timeout(self):
+        """Return how long until due(), or None if we hold nothing."""
+        if self.n:
+            return max(0, self.since + self.delay - self.time())
+
+    def take(self):
+        b = "".join(self.buf)
+        self.buf = []
+        self.n = 0
+        return b
+
+
+class _Job(object):
+    """A request running on one channel of the remote assembler.
+
+    The assembler's main loop selects on rfds() and wfds() of every job,
+    then calls step() on each of them in turn; a job that is busy() has
+    something to send even if none of its fds are ready, and one with a
+    timeout() wants step() called again within that many seconds.  Lines
+    from portsh for this channel are passed to got().  Once rv is set, the
+    job is finished.
+    """
+
+    def __init__(self, ch, codec, send):
+        self.ch = ch
+        self.codec = codec
+        self.send = send
+        self.rv = None
+
+    def fail(self, e):
+        self.send("2 %d %s" % (self.ch, self.codec.encode("%s\n" % e)))
+        self.rv = 1
+
+    def rfds(self):
+        return []
+
+    def wfds(self):
+        return []
+
+    def busy(self):
+        return False
+
+    def timeout(self):
+        return None
+
+    def step(self, r, w):
+        pass
+
+    def got(self, kind, words, data):
+        pass
+
+    def cancel(self):
+        """Stop early, because nobody wants the result anymore."""
+        if self.rv is None:
+            self.rv = 1
+
+
+class _RemoteRun(_Job):
+    """Run a shell command, relaying its stdin, stdout and stderr.
+
+    Output is coalesced according to hold, (seconds, bytes), which
+    assembler() sets from what portsh asked for.  We only read as much of
+    it as portsh has given us credit for; the rest waits in the pipes,
+    where it holds up the command instead of the tty.
+    """
+    hold = (HOLD_MS / 1000.0, HOLD_BYTES)
+
+    def __init__(self, ch, codec, send, cmd):
+        import os, subprocess
+        _Job.__init__(self, ch, codec, send)
+        # In a process group of its own, so cancel() can get all of it.
+        self.p = subprocess.Popen(cmd, shell=True, close_fds=True,
+                                  preexec_fn=os.setpgrp,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        self.outs = {self.p.stdout.fileno(): 1, self.p.stderr.fileno(): 2}
+        self.held = {1: Holder(*self.hold), 2: Holder(*self.hold)}
+        self.credit = OUTPUT_WINDOW
+        self.inbuf = ""
+        self.owed = 0  # stdin consumed but not yet granted back
+        self.eof = False
+
+    def room(self):
+        return self.credit - self.held[1].n - self.held[2].n
+
+    def rfds(self):
+        return self.room() > 0 and self.outs.keys() or []
+
+    def wfds(self):
+        return self.inbuf and [self.p.stdin.fileno()] or []
+
+    def timeout(self):
+        times = [t for t in (h.timeout() for h in self.held.values())
+                 if t is not None]
+        if times:
+            return min(times)
+
+    def step(self, r, w):
+        import errno, os
+        # Service stdout and stderr alike, so neither can starve the other.
+        for fd, n in self.outs.items():
+            if fd in r and self.room() > 0:
+                b = os.read(fd, min(65536, self.room()))
+                if b:
+                    self.held[n].put(b)
+                else:
+                    del self.outs[fd]
+                if not b or self.held[n].due():
+                    self._flush(n)
+        for n, held in self.held.items():
+            if held.due():
+                self._flush(n)
+        if self.inbuf and self.p.stdin.fileno() in w:
+            try:
+                n = os.write(self.p.stdin.fileno(), self.inbuf[:4096])
+            except OSError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+                n = len(self.inbuf)  # nobody is listening anymore
+            self.inbuf = self.inbuf[n:]
+            self.owed += n
+            if self.owed >= STDIN_WINDOW / 2:
+                self.send("G %d %d" % (self.ch, self.owed))
+                self.owed = 0
+        if self.eof and not self.inbuf and not self.p.stdin.closed:
+            self.p.stdin.close()
+        if not self.outs:
+            self.rv = self.p.wait()
+
+    def _flush(self, n):
+        b = self.held[n].take()
+        if b:
+            self.credit -= len(b)
+            # Short lines stand a better chance on a noisy line.
+            for frame in self.codec.frames(b, PULL_FRAME):
+                self.send("%d %d %s" % (n, self.ch, frame))
+
+    def cancel(self):
+        # Hang up on it, like closing its terminal would; we still report
+        # its exit code once it's gone.
+        import os, signal
+        try:
+            os.killpg(self.p.pid, signal.SIGHUP)
+        except OSError:
+            pass
+
+    def got(self, kind, words, data):
+        if kind == "I":
+            self.inbuf += data
+        elif kind == "C":
+            self.eof = True
+        elif kind == "G":
+            self.credit += int(words[2])
+
+
+class _RemoteRecv(_Job):
+    """Receive a pushed file: write each frame and acknowledge it.
+
+    Like PullJob, we write to a temporary file and only rename it over
+    path once the whole file is here, so a failed push leaves path alone.
+    """
+
+    def __init__(self, ch, codec, send, path):
+        import os
+        _Job.__init__(self, ch, codec, send)
+        self.path = path
+        self.tmp = path + ".tmp"
+        try:
+            self.mode = os.stat(path).st_mode & 07777
+        except OSError:
+            self.mode = None
+        self.f = None
+        try:
+            self.f = open(self.tmp, "wb")
+        except IOError, e:
+            self.fail(e)
+
+    def cancel(self):
+        import os
+        if self.f:
+            self.f.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+        _Job.cancel(self)
+
+    def got(self, kind, words, data):
+        import os
+        if self.rv is not None:
+            return
+        try:
+            if kind == "D":
+                self.f.write(data)
+                self.send("A %d %s" % (self.ch, words[2]))
+            elif kind == "E":
+                self.f.close()
+                if self.mode is not None:
+                    os.chmod(self.tmp, self.mode)
+                os.rename(self.tmp, self.path)
+                self.rv = 0
+        except EnvironmentError, e:
+            self.cancel()
+            self.fail(e)
+
+
+class _RemoteSend(_Job):
+    """Send a pulled file, keeping a window of unacknowledged frames."""
+
+    def __init__(self, ch, codec, send, path):
+        _Job.__init__(self, ch, codec, send)
+        self.seq = self.acked = 0
+        self.pending = []
+        self.eof = False
+        try:
+            self.f = open(path, "rb")
+        except IOError, e:
+            self.fail(e)
+
+    def busy(self):
+        return (self.rv is None and not self.eof and
+                self.seq - self.acked < PULL_WINDOW)
+
+    def step(self, r, w):
+        if not self.busy():
+            return
+        if not self.pending:
+            b = self.f.read(FILE_CHUNK)
+            if b:
+                self.pending = self.codec.frames(b, PULL_FRAME)
+            else:
+                self.f.close()
+                self.eof = True
+                self.send("E %d %d" % (self.ch, self.seq))
+        if self.pending:
+            self.seq += 1
+            self.send("D %d %d %s" % (self.ch, self.seq, self.pending.pop(0)))
+        if self.eof and self.acked == self.seq:
+            self.rv = 0
+
+    def got(self, kind, words, data):
+        if kind == "A":
+            self.acked = max(self.acked, int(words[2]))
+        if self.eof and self.acked == self.seq:
+            self.rv = 0
+
+
 def assembler(splitter):
-    import os, select, subprocess, sys, zlib
+    import os, select, sys, termios
 
-    zc = zlib.compressobj()
-    zd = zlib.decompressobj()
-    def encode(b):
-        return ((zc.compress(b) + zc.flush(zlib.Z_SYNC_FLUSH))
-                .encode("base64").replace("\n", ""))
+    codec = Codec()
     def decode(b):
         try:
-            return zd.decompress(b.strip().decode("base64"))
+            return codec.decode(b)
         except Exception:
-            sys.stderr.write("ERROR base64 decode: %r\n" % b)
+            sys.stderr.write("ERROR %s decode: %r\n" % (codec.rx, b))
             raise
+    def write(line):
+        print line
 
-    cmd = decode(sys.stdin.readline())
+    # Show portsh which bytes survive the tty on the way out, and tell it
+    # which of its own came through.  See negotiate().
+    print "%s %s-PROBE" % (_probe(PROBE_DOWN), splitter)
+    print "%s %s-PROBED" % (",".join("%02x" % v for v in
+                                     _mangled(sys.stdin.readline(),
+                                              PROBE_UP)),
+                            splitter)
+    up, down, speeds, hold = sys.stdin.readline().split()
+    codec.use(down, up)
+    ms, nbytes = hold.split(",")
+    _RemoteRun.hold = (int(ms) / 1000.0, int(nbytes))
+    shifted_from = None
+    if speeds != "-":
+        shifted_from = _upshift(splitter, speeds)
+    # Line noise is now just a damaged frame, unless it turns into ^C or
+    # ^S on the way.
+    saved = termios.tcgetattr(0)
+    tc = termios.tcgetattr(0)
+    tc[0] &= ~termios.IXON
+    tc[3] &= ~(termios.ISIG | termios.IEXTEN)
+    termios.tcsetattr(0, termios.TCSANOW, tc)
+    rates = dict((getattr(termios, name), int(name[1:]))
+                 for name in dir(termios)
+                 if name[:1] == "B" and name[1:].isdigit())
+    framer = Framer(write, rates.get(tc[5], 0))
+    send = framer.send
     print "%s-RUNNING" % splitter
 
-    p = subprocess.Popen(cmd, shell=True,
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
-    fds = [sys.stdin, p.stdout, p.stderr]
-    while p.stdout in fds or p.stderr in fds:
-        r,w,x = select.select(fds, [], [])
-        if p.stderr in r:
-            b = os.read(p.stderr.fileno(), 4096)
-            if b:
-                print "2 %s" % encode(b)
-            else:
-                fds.remove(p.stderr)
-        elif p.stdout in r:
-            b = os.read(p.stdout.fileno(), 4096)
-            if b:
-                print "1 %s" % encode(b)
-            else:
-                fds.remove(p.stdout)
-        elif sys.stdin in r:
-            b = os.read(sys.stdin.fileno(), 4096)
-            if b:
-                p.stdin.write(decode(b))
-            else:
-                fds.remove(sys.stdin)
-                p.stdin.close()
-    rv = p.wait()
-    print "%s-EXIT-%d" % (splitter, rv)
+    kinds = {"run": _RemoteRun, "push": _RemoteRecv, "pull": _RemoteSend}
+    jobs = {}
+    turn = 0
+    quitting = False
+    try:
+        # Don't go until portsh has everything we sent it.
+        while jobs or not quitting or framer.unacked:
+            rl = [0]
+            wl = []
+            timeout = framer.timeout()
+            for job in jobs.values():
+                rl += job.rfds()
+                wl += job.wfds()
+                if job.busy():
+                    timeout = 0
+                t = job.timeout()
+                if t is not None and (timeout is None or t < timeout):
+                    timeout = t
+            r,w,x = select.select(rl, wl, [], timeout)
+            lines = []
+            if 0 in r:
+                line = os.read(0, 8192)
+                if not line:
+                    break  # portsh is gone, so there's nobody left to talk to
+                line = line.rstrip("\r\n")
+                if line and not line.strip("\x03"):
+                    # Nothing but ^C: portsh gave up on us, or a new one is
+                    # prodding us at login.
+                    break
+                lines = framer.got(line) or []
+            for line in lines:
+                kind = line[:1]
+                words = line.split(" ", kind == "D" and 3 or 2)
+                # Every payload must be decoded, in order, to keep the zlib
+                # stream in sync, even if its channel has already finished.
+                data = kind in ("R", "I", "D") and decode(words[-1]) or ""
+                if kind == "Q":
+                    quitting = True
+                elif kind == "R":
+                    job_kind, arg = data.split(" ", 1)
+                    ch = int(words[1])
+                    jobs[ch] = kinds[job_kind](ch, codec, send, arg)
+                elif kind == "K" and int(words[1]) in jobs:
+                    jobs[int(words[1])].cancel()
+                elif line and int(words[1]) in jobs:
+                    jobs[int(words[1])].got(kind, words, data)
+            # Take turns going first, so no channel can hog the line.
+            chans = sorted(jobs)
+            if chans:
+                turn = (turn + 1) % len(chans)
+                chans = chans[turn:] + chans[:turn]
+            for ch in chans:
+                job = jobs[ch]
+                if job.rv is None:
+                    job.step(r, w)
+                if job.rv is not None:
+                    send("X %d %d" % (ch, job.rv))
+                    del jobs[ch]
+            framer.step()
+    finally:
+        # Leave the tty as we found it, baud rate included (the next login
+        # won't expect the fast one), and throw away whatever else is
+        # coming (a prod at login goes on to ^D, which would otherwise log
+        # the shell out).  Nobody is left to want what jobs still running
+        # would produce.
+        if shifted_from is not None:
+            _unshift(splitter, shifted_from, rates.get(shifted_from, 0))
+            saved[4] = saved[5] = shifted_from
+        termios.tcsetattr(0, termios.TCSANOW, saved)
+        termios.tcflush(0, termios.TCIFLUSH)
+        for job in jobs.values():
+            job.cancel()
+    print "%s-EXIT-0" % splitter
 # END ASSEMBLER
 # The above is the stage2 assembler that gets run on the remote
 # system. To ensure that syntax errors and exceptions have useful line
 # numbers, keep it at the top of the file.
 
-import re, os, sys, tty, termios, fcntl, select, array, time, uuid, zlib
+import re, os, sys, tty, termios, fcntl, select, array, time, zlib
+import glob, hashlib, json, signal, socket, tempfile
 import options
 import port
 
 optspec = """
 portsh [options...] <tty> <command string...>
+portsh [options...] -m <tty> <command> <command...>
+portsh [options...] push <tty> <local file> <remote file>
+portsh [options...] pull <tty> <remote file> <local file>
+portsh [options...] --daemon <tty>
+portsh [options...] --fanout <ttys> <command string...>
 --
 t,trace     show serial port trace on stderr
+m,multi     run each argument after <tty> as a separate command, all at once
+d,daemon    stay logged in, and run later portsh commands for <tty> quickly
+f,fanout=   run the command on each of these comma-separated ttys or globs
+j,jobs=     with --fanout, how many ttys to work on at once [16]
+outdir=     with --fanout, write each tty's output to DIR/<tty>.out
 s,speed=    the baud rate to use [115200]
+wait=       if the tty is locked, wait up to this many seconds for it [0]
+profile=    tune for 'interactive' latency or 'bulk' throughput [interactive]
+upshift=    once logged in, switch to the fastest rate up to this that works
+coalesce=   hold output and stdin for up to MS,BYTES before sending it [5,1024]
+bulk        coalesce for throughput, like --coalesce=50,16384
+stats       show throughput while running, and a summary of the session at exit
+stats-json= write a JSON report of the session to this file at exit
 u,user=     response to 'login:' prompt [root]
 p,password= response to 'Password:' prompt
 """
@@ -108,9 +855,21 @@ def trace(s):
 
 
 class Reader(object):
+    """Buffers lines arriving from fd, turning CRLF into LF.
+
+    Data lives in a bytearray with a read offset, so consuming a line
+    doesn't copy everything after it.  The consumed part is only discarded
+    once it makes up most of the buffer.
+    """
+
     def __init__(self, fd):
         self.fd = fd
-        self.buf = ''
+        self.buf = bytearray()
+        self.ofs = 0
+        self.miss = None  # (sep, len(buf)) after get_until() finds nothing
+
+    def __len__(self):
+        return len(self.buf) - self.ofs
 
     def fill(self, timeout):
         r,w,x = select.select([self.fd], [], [], timeout)
@@ -118,22 +877,47 @@ class Reader(object):
             nbuf = os.read(self.fd, 4096)
             if nbuf:
                 trace('(%d)' % len(nbuf))
-                self.buf += nbuf.replace('\r\n', '\n')
+                self.put(nbuf)
                 return nbuf
         return ''
 
+    def put(self, nbuf):
+        """Append nbuf as if it had just been read from fd."""
+        if (nbuf.startswith('\n') and len(self.buf) > self.ofs and
+            self.buf[-1] == 13):
+            del self.buf[-1]  # the CRLF was split across two reads
+            if self.miss:
+                # The LF goes where the CR was, which we already searched.
+                self.miss = (self.miss[0], self.miss[1] - 1)
+        if self.ofs > 65536 and self.ofs * 2 > len(self.buf):
+            del self.buf[:self.ofs]
+            self.ofs = 0
+            self.miss = None
+        self.buf += nbuf.replace('\r\n', '\n')
+
     def get(self, nbytes):
-        out = self.buf[:nbytes]
-        self.buf = self.buf[nbytes:]
+        end = min(self.ofs + nbytes, len(self.buf))
+        out = str(buffer(self.buf, self.ofs, end - self.ofs))
+        if end == len(self.buf):
+            self.buf = bytearray()
+            self.ofs = 0
+            self.miss = None
+        else:
+            self.ofs = end
         return out
 
     def get_until(self, sep):
-        pos = self.buf.find(sep)
+        start = self.ofs
+        if self.miss and self.miss[0] == sep:
+            # Don't rescan what we already searched last time.
+            start = max(start, self.miss[1] - len(sep) + 1)
+        pos = self.buf.find(sep, start)
         if pos >= 0:
-            return self.get(pos + len(sep))
+            return self.get(pos - self.ofs + len(sep))
+        self.miss = (sep, len(self.buf))
 
     def get_all(self):
-        return self.get(len(self.buf))
+        return self.get(len(self))
 
     def lines(self):
         while 1:
@@ -143,160 +927,1272 @@ class Reader(object):
             yield line
 
 
-def read_until_idle(fd, start_timeout):
-    timeout = start_timeout
-    buf = ''
-    while 1:
-        r,w,x = select.select([fd], [], [], timeout)
-        if r:
-            nbuf = os.read(fd, 4096)
-            if nbuf:
-                trace('(%d)' % len(nbuf))
-            buf += nbuf
-            timeout = 0.1
-        else:
-            break
-    return buf
+# Logging in and starting stage2 are done by coroutines, run by a
+# port.Loop (see there), so one process can bring up many sessions at once.
 
+# Patterns given to Expect can't reach back further than this into data
+# that was already searched.
+EXPECT_LOOKBACK = 256
 
-def get_shell_prompt(fd, user, password):
-    # Send some ctrl-c (SIGINTR) and newlines as a basic terminal reset.
-    os.write(fd, '\x03\x03\x03\r\n')
-    last_was_sh = 0
-    buf = read_until_idle(fd, 0.0)
-    for tries in range(10):
-        trace(buf.replace('\r', ''))
-        bufclean = buf.lower().strip()
-        if bufclean.endswith('login:'):
-            os.write(fd, user + '\n')
-        elif bufclean.endswith('password:'):
-                os.write(fd, password + '\n')
-                trace('(password)')
-        elif ('%s%s' % ('MAGIC', 'STRING')) in buf.replace('\r', ''):
-            # success!
-            trace('(got a shell prompt)\n')
-            return
-        elif (not last_was_sh and
-              (bufclean.endswith('#') or bufclean.endswith('$') or # sh
-               bufclean.endswith('%') or bufclean.endswith('>') or # csh/tcsh
-               '\x1b' in bufclean)):  # fancy ansi characters
-            # probably shell prompt
+# How long to wait for a shell prompt in all, and how long to wait for
+# anything at all to happen before trying to shake something loose.
+LOGIN_TIMEOUT = 30.0
+PROD_AFTER = 2.0
+
+
+class Expect(object):
+    """Watches what arrives on a Reader for any of a table of patterns.
+
+    table is a list of (regex, action) pairs.  The earliest match of any
+    of the patterns (the first one in the table, if several match at the
+    same place) is taken out of the reader, along with everything before
+    it, and its action is called with the match object.  Matching ignores
+    case, and '$' means the end of what has arrived so far.
+
+    Only data that arrived since the last search, and EXPECT_LOOKBACK
+    bytes before it, is searched again, so the cost of a search doesn't
+    grow with the amount of unmatched data piling up.
+    """
+
+    def __init__(self, reader, table):
+        self.reader = reader
+        self.actions = [action for regex, action in table]
+        self.regex = re.compile('|'.join('(?P<_%d>%s)' % (i, regex)
+                                         for i, (regex, action)
+                                         in enumerate(table)),
+                                re.IGNORECASE)
+        self.seen = 0  # how much of the reader's data we've searched
+
+    def match(self):
+        """Consume the next match, if any; return (action, match) or None."""
+        reader = self.reader
+        start = max(0, min(self.seen, len(reader)) - EXPECT_LOOKBACK)
+        m = self.regex.search(str(buffer(reader.buf, reader.ofs + start)))
+        if not m:
+            self.seen = len(reader)
+            return None
+        reader.get(start + m.end())
+        self.seen = 0
+        return self.actions[int(m.lastgroup[1:])], m
+
+    def run(self, timeout, what, idle=None):
+        """Call actions as their patterns arrive, until one returns a value.
+
+        That value is our return value.  If nothing does within timeout
+        seconds, raise ModemError saying we didn't get what.  idle, if
+        given, is (seconds, function) to call whenever nothing has matched
+        for that long.
+        """
+        now = time.time()
+        deadline = now + timeout
+        last = now
+        while 1:
+            found = self.match()
+            if found:
+                action, m = found
+                trace('(expect: %r)\n' % m.group())
+                last = time.time()
+                rv = action(m)
+                if rv is not None:
+                    raise port.Return(rv)
+                continue
+            now = time.time()
+            if now >= deadline:
+                raise port.ModemError("didn't get %s in %gs" % (what, timeout))
+            wait = deadline - now
+            if idle:
+                if now - last >= idle[0]:
+                    idle[1]()
+                    last = now
+                wait = min(wait, last + idle[0] - now)
+            r = yield [self.reader.fd], wait
+            if r:
+                trace(self.reader.fill(0))
+
+
+def get_shell_prompt(reader, user, password):
+    fd = reader.fd
+    magic = '%s%s' % ('MAGIC', 'STRING')
+    tested = [0]
+
+    def send_user(m):
+        os.write(fd, user + '\n')
+
+    def send_password(m):
+        os.write(fd, password + '\n')
+        trace('(password)')
+
+    def prompt(m):
+        # Probably a shell prompt.  A shell prints a few of them in a row
+        # when we reset it, but one test will do.
+        if time.time() - tested[0] >= 1.0:
             os.write(fd, 'printf MAGIC; printf STRING\r')
             trace('(shelltest)\n')
-            last_was_sh = 1
-        else:
-            last_was_sh = 0
-            r,w,x = select.select([fd], [], [], 2.0)
-            if not r:
-                # Send some ctrl-c (SIGINTR), ctrl-d (EOF), and
-                #  ctrl-\ (SIGQUIT) to try to exit out of anything
-                #  already running.
-                trace('(prodding)\n')
-                os.write(fd, '\x03\x03\x03\r\n\x04\x04\x04\x1c\x1c\x1c\r\n')
-        buf = read_until_idle(fd, 1.0)
-    raise port.ModemError("couldn't get a shell prompt after 10 tries")
-
-
-def wait_for_string(reader, s):
-    timeout = 10.0
-    for i in range(50):
-        nbuf = reader.fill(timeout)
-        timeout = 1.0
-        trace(nbuf)
-        got = reader.get_until(s)
+            tested[0] = time.time()
+
+    def prod():
+        # Send some ctrl-c (SIGINTR), ctrl-d (EOF), and ctrl-\ (SIGQUIT)
+        # to try to exit out of anything already running.
+        trace('(prodding)\n')
+        os.write(fd, '\x03\x03\x03\r\n\x04\x04\x04\x1c\x1c\x1c\r\n')
+
+    # Send some ctrl-c (SIGINTR) and newlines as a basic terminal reset.
+    os.write(fd, '\x03\x03\x03\r\n')
+    yield Expect(reader, [
+        (r'login:\s*$', send_user),
+        (r'password:\s*$', send_password),
+        (magic, lambda m: True),
+        # sh, csh/tcsh, or fancy ansi characters
+        (r'(?:[#$%>]|\x1b\[[\d;]*[a-z])\s*$', prompt),
+    ]).run(LOGIN_TIMEOUT, 'a shell prompt', idle=(PROD_AFTER, prod))
+    trace('(got a shell prompt)\n')
+
+
+def wait_for_string(reader, s, timeout=60.0):
+    """Wait for s to arrive on reader; return what came before it."""
+    deadline = time.time() + timeout
+    while 1:
+        got = reader.get_until(s)  # it may have arrived with earlier data
         if got:
             trace('(got %s)' % s)
-            return got[:-len(s)]
-    raise port.ModemError("didn't find %r after 10 tries")
+            raise port.Return(got[:-len(s)])
+        left = deadline - time.time()
+        if left <= 0:
+            raise port.ModemError("didn't find %r in %gs" % (s, timeout))
+        r = yield [reader.fd], left
+        if r:
+            trace(reader.fill(0))
 
 
+# The stage2 script is cached on the remote side under its hash, so we
+# only need to upload it the first time.  Nothing protects the upload from
+# line noise but that hash, so it is sent again, up to UPLOAD_TRIES times
+# in all, until it arrives intact.
+UPLOAD_TRIES = 3
 PY_SCRIPT1 = r"""
 stty sane; stty -echo; python -Sc '
-import sys, zlib
-print "%s-READY\n" % "SPLITTER";
-b = sys.stdin.readline().strip()
+import sys, zlib, os, hashlib
+d = os.path.isdir("/dev/shm") and "/dev/shm" or "/tmp"
+p = "%s/portsh-%s" % (d, "HASH")
+try: b = open(p).read()
+except IOError: b = ""
+m = u = hashlib.sha1(b).hexdigest() != "HASH"
+print "%s-READY-%d\n" % ("SPLITTER", m);
+while m:
+    b = ""
+    for l in iter(sys.stdin.readline, "\n"):
+        if not l: sys.exit(1)
+        b += l.strip()
+    m = hashlib.sha1(b).hexdigest() != "HASH"
+    print "%s-READY-%d\n" % ("SPLITTER", m);
+if u:
+    try:
+        open("%s.%d" % (p, os.getpid()), "w").write(b)
+        os.rename("%s.%d" % (p, os.getpid()), p)
+    except (IOError, OSError): pass
 exec(zlib.decompress(b.decode("base64")))
 assembler("SPLITTER")
 '; printf %s-EXIT-97\\n SPLITTER; stty sane; cat
 """
 
-def main():
-    o = options.Options(optspec)
-    (opt, flags, extra) = o.parse(sys.argv[1:])
-    if len(extra) < 2:
-        o.fatal("exactly one tty name and a command expected")
-    if opt.trace:
-        global _want_trace
-        _want_trace = opt.trace
-    filename = extra[0]
-    cmd = ' '.join(extra[1:])
+def stage2_script():
+    """Return the assembler's source, compressed and base64-encoded.
 
-    modem = port.Modem(filename, opt.speed)
-    get_shell_prompt(modem.fd, opt.user, opt.password or '')
+    Comments and docstrings are only dead weight on a slow line, so they
+    are left out.  Lines are kept, though, so the line numbers in a
+    traceback from the remote end still match this file.
+    """
+    import cStringIO, tokenize
+    py_script, junk = open(__file__).read().split('# END ASSEMBLER\n', 1)
+    assert junk
+    lines = py_script.splitlines(True)
+    prev = tokenize.NEWLINE
+    cuts = []
+    tokens = list(tokenize.generate_tokens(cStringIO.StringIO(py_script)
+                                           .readline))
+    for i, (kind, s, start, end, line) in enumerate(tokens):
+        if kind == tokenize.COMMENT:
+            cuts.append((start, end, ''))
+        elif (kind == tokenize.STRING and tokens[i+1][0] == tokenize.NEWLINE
+              and prev in (tokenize.NEWLINE, tokenize.INDENT,
+                           tokenize.DEDENT)):
+            cuts.append((start, end, '""'))  # a docstring
+        if kind not in (tokenize.COMMENT, tokenize.NL):
+            prev = kind
+    for (srow, scol), (erow, ecol), s in reversed(cuts):
+        lines[srow-1] = (lines[srow-1][:scol] + s +
+                         lines[erow-1][ecol:]).rstrip() + '\n'
+        for row in range(srow, erow):
+            lines[row] = '\n'
+    return zlib.compress(''.join(lines), 9).encode('base64').replace('\n', '')
 
-    splitter = uuid.uuid4().hex
-    reader = Reader(modem.fd)
 
-    zc = zlib.compressobj()
-    zd = zlib.decompressobj()
-    def encode(b):
-        return ((zc.compress(b) + zc.flush(zlib.Z_SYNC_FLUSH))
-                .encode('base64').replace('\n', ''))
-    def decode(b):
-        return zd.decompress(b.strip().decode('base64'))
+def choose_encoding(bad):
+    """Pick the densest wire encoding that avoids the byte values in bad."""
+    # \r and \n delimit lines, and '=' is the escape character itself.
+    esc = sorted(set(bad) | set([0x0a, 0x0d, 0x3d]))
+    if (0x3d not in bad and len(esc) < 64 and
+        not [v for v in esc if (v + 64) & 0xff in esc]):
+        # Costs one byte per escaped value, so under 25% even in the worst
+        # case, and about 1% for compressed data on an 8-bit clean link.
+        return 'esc8:' + ','.join('%02x' % v for v in esc)
+    elif not [v for v in bad if 0x21 <= v <= 0x75]:
+        return 'b85'
+    else:
+        return 'b64'
 
-    os.write(modem.fd,
-             "%s\r" % PY_SCRIPT1.strip().replace('SPLITTER', splitter))
-    wait_for_string(reader, '%s-READY\n' % splitter)
 
-    py_script, junk = open(__file__).read().split('# END ASSEMBLER\n', 1)
-    assert junk
-    cpy_script = zlib.compress(py_script).encode('base64').replace('\n', '')
-    trace('(cpy_script=%d)' % len(cpy_script))
-    os.write(modem.fd, "%s\r" % cpy_script)
-    zc = zlib.compressobj()
-    os.write(modem.fd, "%s\r" % encode(cmd))
-    wait_for_string(reader, '%s-RUNNING\n' % splitter)
-    split_end = '%s-EXIT-' % splitter
-
-    fds = [0, modem.fd]
-    while 1:
-        r,w,x = select.select(fds, [], [])
-        if 0 in r:
-            buf = os.read(0, 128)
+# Rates worth trying to upshift to, if termios on both ends knows them.
+UPSHIFT_SPEEDS = [57600, 115200, 230400, 460800, 500000, 576000, 921600,
+                  1000000, 1152000, 1500000, 2000000, 2500000, 3000000,
+                  3500000, 4000000]
+
+
+def _wait_line(reader, timeout):
+    """Return the next line from reader, or None after timeout seconds."""
+    deadline = time.time() + timeout
+    line = reader.get_until('\n')
+    while not line and time.time() < deadline:
+        r = yield [reader.fd], max(0, deadline - time.time())
+        if r:
+            trace(reader.fill(0))
+        line = reader.get_until('\n')
+    raise port.Return(line)
+
+
+def upshift(modem, reader, splitter):
+    """Switch both ends to the rate chosen by _upshift(), if it works.
+
+    Falls back to modem.speed if the test pattern doesn't survive.
+    """
+    yield wait_for_string(reader, '%s-SHIFT ' % splitter)
+    speed = int((yield wait_for_string(reader, '\n')))
+    if not speed:
+        log('portsh: remote end knows no faster baud rate\n')
+        return
+    old = modem.speed
+    termios.tcdrain(modem.fd)
+    modem.set_speed(speed)
+    yield [], 0.1  # until the remote end has switched too
+    termios.tcflush(modem.fd, termios.TCIFLUSH)
+    os.write(modem.fd, SHIFT_PATTERN + '\n')
+    shifted = '%s-SHIFTED ' % splitter
+    result = None
+    deadline = time.time() + 1
+    while result is None and time.time() < deadline:
+        line = yield _wait_line(reader, deadline - time.time())
+        if line == SHIFT_PATTERN + '\n':
+            os.write(modem.fd, 'ok\n')
+            deadline = time.time() + 1
+        elif line and shifted in line:
+            result = int(line.split(shifted, 1)[1])
+    if result is None:
+        # The remote end gives up too, and says so at the old rate.
+        modem.set_speed(old)
+        yield wait_for_string(reader, shifted)
+        result = int((yield wait_for_string(reader, '\n')))
+    if result == speed:
+        trace('(speed: %d)\n' % speed)
+    else:
+        modem.set_speed(old)
+        log('portsh: %d baud failed; staying at %d\n' % (speed, old))
+
+
+def negotiate(modem, reader, codec, splitter, max_speed=None,
+              hold=(HOLD_MS, HOLD_BYTES)):
+    """Agree on the densest encodings the tty can carry each way.
+
+    If max_speed is given, also try to upshift() to a rate up to that.
+    hold is the (ms, bytes) the assembler should coalesce output for.
+    """
+    got = yield wait_for_string(reader, '%s-PROBE\n' % splitter)
+    down = choose_encoding(_mangled(got, PROBE_DOWN))
+    os.write(modem.fd, '%s\n' % _probe(PROBE_UP))
+    got = yield wait_for_string(reader, '%s-PROBED\n' % splitter)
+    bad = set(int(h, 16) for h in got.strip().split('\n')[-1].split(',') if h)
+    bad |= set(range(0x20)) | set([0x7f])
+    if [v for v in bad if v >= 0xa0]:
+        bad |= set(range(0x80, 0xa0))
+    up = choose_encoding(bad)
+    speeds = [str(v) for v in UPSHIFT_SPEEDS
+              if modem.speed < v <= int(max_speed or 0) and
+              hasattr(termios, 'B%d' % v)]
+    os.write(modem.fd, '%s %s %s %d,%d\n' % (up, down, ','.join(speeds) or '-',
+                                            hold[0], hold[1]))
+    codec.use(up, down)
+    trace('(encoding: up=%s down=%s)\n' % (up, down))
+    if speeds:
+        yield upshift(modem, reader, splitter)
+
+
+def _other_line(reader, split_end, line):
+    """Handle a line that isn't part of any job.
+
+    Returns the assembler's exit code once it arrives, else None.
+    """
+    if split_end in line:
+        pre, rv = line.split(split_end, 1)
+        assert not pre
+        trace('(rv=%r)' % rv)
+        return int(rv)
+    elif (line.startswith('Traceback ') or
+          line.startswith('ERROR')):
+        log(line)
+        nbuf = 1
+        while nbuf:
+            nbuf = reader.fill(1)
+            log(nbuf)
+    else:
+        # Most likely a frame that got mangled on the way; the Framer will
+        # have asked for it again.
+        trace('(damaged: %r)\n' % line)
+
+
+class Job(object):
+    """A request that portsh runs on one channel of the assembler.
+
+    This is the local half of _Job: Session.run() selects on rfds() of
+    every job and calls step() on each, and a job that is busy() has
+    something to send even if none of its fds are ready, and one with a
+    timeout() wants step() called again within that many seconds.  Lines
+    for the job's channel are passed to got(), and done() gets the remote
+    exit code.
+    """
+    kind = None
+
+    def __init__(self, arg):
+        self.arg = arg
+        self.session = self.ch = self.rv = None
+
+    def start(self):
+        pass
+
+    def rfds(self):
+        return []
+
+    def busy(self):
+        return False
+
+    def timeout(self):
+        return None
+
+    def unacked(self):
+        return 0
+
+    def step(self, r):
+        pass
+
+    def got(self, kind, words, data):
+        if kind in ('1', '2'):
+            self.output(int(kind), data)
+
+    def output(self, fd, data):
+        """Deliver data to our stdout (fd 1) or stderr (fd 2)."""
+        os.write(fd, data)
+
+    def report(self, what, nbytes, start):
+        secs = max(time.time() - start, 0.001)
+        self.output(2, '(%s %d bytes in %.1fs: %.0f bytes/sec)\n'
+                    % (what, nbytes, secs, nbytes / secs))
+
+    def done(self, rv):
+        self.rv = rv
+
+    def cancel(self):
+        """Clean up after a job that will never be done()."""
+        pass
+
+
+class RunJob(Job):
+    """Run a command, optionally feeding it our stdin.
+
+    If prefix is given, every line of output starts with it, so the output
+    of several commands at once can be told apart.  Stdin is coalesced
+    like the assembler coalesces output, but never into more than
+    MAX_STDIN bytes per line, and we stop reading it while the assembler
+    has no room for more.  Output is granted back as it is written.
+    """
+    kind = 'run'
+
+    def __init__(self, cmd, stdin=None, prefix=''):
+        Job.__init__(self, cmd)
+        self.stdin = stdin
+        self.prefix = prefix
+        self.partial = {1: '', 2: ''}
+        self.held = None
+        self.credit = STDIN_WINDOW
+        self.owed = 0  # output written but not yet granted back
+
+    def start(self):
+        ms, nbytes = self.session.hold
+        self.held = Holder(ms / 1000.0, min(nbytes, MAX_STDIN))
+        if self.stdin is None:
+            self.session.send('C %d' % self.ch)
+
+    def room(self):
+        return min(self.credit, MAX_STDIN) - self.held.n
+
+    def rfds(self):
+        return (self.stdin is not None and self.room() > 0 and
+                [self.stdin] or [])
+
+    def timeout(self):
+        return self.held.timeout()
+
+    def step(self, r):
+        if self.stdin is not None and self.stdin in r and self.room() > 0:
+            buf = os.read(self.stdin, self.room())
             if len(buf):
                 trace('>>%s' % buf)
-                os.write(modem.fd, encode(buf) + '\n')
+                self.session.stats.count('stdin', len(buf))
+                self.held.put(buf)
+            else:
+                self._flush()
+                self.session.send('C %d' % self.ch)
+                self.stdin = None
+        if self.held.due():
+            self._flush()
+
+    def _flush(self):
+        buf = self.held.take()
+        if buf:
+            self.credit -= len(buf)
+            self.session.send('I %d %s'
+                              % (self.ch, self.session.codec.encode(buf)))
+
+    def got(self, kind, words, data):
+        if kind == 'G':
+            self.credit += int(words[2])
+            return
+        self.owed += len(data)
+        if kind in ('1', '2') and self.prefix:
+            lines = (self.partial[int(kind)] + data).split('\n')
+            self.partial[int(kind)] = lines.pop()
+            data = ''.join('%s%s\n' % (self.prefix, l) for l in lines)
+        Job.got(self, kind, words, data)
+        if self.owed >= OUTPUT_WINDOW / 2 and self.rv is None:
+            self.session.send('G %d %d' % (self.ch, self.owed))
+            self.owed = 0
+
+    def done(self, rv):
+        for fd in (1, 2):
+            if self.partial[fd]:
+                self.got(str(fd), None, '\n')
+        Job.done(self, rv)
+
+
+class PushJob(Job):
+    """Send the contents of f as a window of acknowledged frames."""
+    kind = 'push'
+
+    def __init__(self, f, dst):
+        Job.__init__(self, dst)
+        self.f = f
+        self.nbytes = self.seq = self.acked = 0
+        self.pending = []
+        self.eof = False
+        self.start_time = time.time()
+
+    def busy(self):
+        # The window is shared by all pushes; see PUSH_WINDOW.
+        return (not self.eof and self.rv is None and
+                self.session.unacked() < PUSH_WINDOW)
+
+    def unacked(self):
+        return self.seq - self.acked
+
+    def step(self, r):
+        if not self.busy():
+            return
+        if not self.pending:
+            b = self.f.read(FILE_CHUNK)
+            self.nbytes += len(b)
+            self.session.stats.count('push', len(b))
+            if b:
+                self.pending = self.session.codec.frames(b, PUSH_FRAME)
             else:
-                os.write(modem.fd, '\n\x04')  # EOF signal
-                fds.remove(0)
-        if modem.fd in r:
-            nbuf = 1
-            while nbuf:
-                nbuf = reader.fill(0.1)
+                self.eof = True
+                self.session.send('E %d %d' % (self.ch, self.seq))
+                return
+        self.seq += 1
+        self.session.send('D %d %d %s' % (self.ch, self.seq,
+                                          self.pending.pop(0)))
+
+    def got(self, kind, words, data):
+        if kind == 'A':
+            self.acked = max(self.acked, int(words[2]))
+        else:
+            Job.got(self, kind, words, data)
+
+    def done(self, rv):
+        if not rv:
+            self.report('pushed', self.nbytes, self.start_time)
+        Job.done(self, rv)
+
+
+class PullJob(Job):
+    """Receive frames into the file dst, acknowledging each one as it arrives.
+
+    They go to a temporary file next to dst, which only replaces it once
+    the remote end says the whole file was sent, so a failed pull leaves
+    dst alone.
+    """
+    kind = 'pull'
+
+    def __init__(self, src, dst):
+        Job.__init__(self, src)
+        fd, self.tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(dst),
+                                        dir=os.path.dirname(dst) or '.')
+        try:
+            mode = os.stat(dst).st_mode & 07777
+        except OSError:
+            mode = os.umask(0)
+            os.umask(mode)
+            mode = 0666 & ~mode
+        os.fchmod(fd, mode)
+        self.f = os.fdopen(fd, 'wb')
+        self.dst = dst
+        self.nbytes = 0
+        self.start_time = time.time()
+
+    def got(self, kind, words, data):
+        if kind == 'D':
+            self.f.write(data)
+            self.nbytes += len(data)
+            self.session.send('A %d %s' % (self.ch, words[2]))
+        elif kind == 'E':
+            self.f.close()
+        else:
+            Job.got(self, kind, words, data)
+
+    def cancel(self):
+        self.f.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+    def done(self, rv):
+        if rv:
+            self.cancel()
+        else:
+            self.f.close()
+            os.rename(self.tmp, self.dst)
+            self.report('pulled', self.nbytes, self.start_time)
+        Job.done(self, rv)
+
+
+class Stats(object):
+    """Where a session's time and bytes went, for --stats and --stats-json.
+
+    If interval is set, tick() logs the throughput over each interval.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.start = self.mark = time.time()
+        self.phases = {}
+        self.payload = dict.fromkeys(['stdin', 'stdout', 'stderr',
+                                      'push', 'pull'], 0)
+        self.wire = [0, 0]  # bytes up, down
+        self.lines = [0, 0]
+        self.upload = 0
+        self.last = (self.start, 0, 0)
+
+    def phase(self, name):
+        """Charge the time since the last phase ended to this one."""
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0) + now - self.mark
+        self.mark = now
+
+    def count(self, stream, nbytes):
+        self.payload[stream] += nbytes
+
+    def sent(self, nbytes):
+        self.wire[0] += nbytes
+        self.lines[0] += 1
+
+    def received(self, nbytes):
+        self.wire[1] += nbytes
+
+    def tick(self):
+        now = time.time()
+        t, up, down = self.last
+        if self.interval and now - t >= self.interval:
+            log('(up %.0f bytes/sec, down %.0f bytes/sec)\n'
+                % ((self.wire[0] - up) / (now - t),
+                   (self.wire[1] - down) / (now - t)))
+            self.last = (now, self.wire[0], self.wire[1])
+
+    def report(self, session):
+        """Return the numbers for session as a dict, ready for JSON."""
+        secs = max(self.phases.get('exec', 0), 0.001)
+        codec = session.codec
+        out = dict(phases=self.phases,
+                   payload=self.payload,
+                   speed=session.modem.speed,
+                   stage2_upload=self.upload)
+        for name, counts, wire, lines, enc in (
+                ('up', codec.sent, self.wire[0], self.lines[0], codec.tx),
+                ('down', codec.received, self.wire[1], self.lines[1],
+                 codec.rx)):
+            out[name] = dict(encoding=enc,
+                             payload=counts[0],
+                             compressed=counts[1],
+                             encoded=counts[2],
+                             wire=wire,
+                             lines=lines,
+                             ratio=counts[1] and
+                                   float(counts[0]) / counts[1] or None,
+                             bytes_per_sec=wire / secs)
+        out['up']['resent'] = session.framer.resent
+        out['down']['damaged'] = session.framer.damaged
+        return out
+
+
+def _show_stats(report):
+    for phase in ('login', 'bootstrap', 'exec'):
+        if phase in report['phases']:
+            log('(%-9s %8.3fs)\n' % (phase, report['phases'][phase]))
+    log('(payload: %s)\n' % ', '.join('%s=%d' % kv for kv
+                                      in sorted(report['payload'].items())))
+    for name in ('up', 'down'):
+        d = report[name]
+        log('(%-4s %s: %d payload, %d compressed (%.2fx), %d encoded, '
+            '%d on the wire in %d lines, %.0f bytes/sec)\n'
+            % (name, d['encoding'].split(':')[0], d['payload'],
+               d['compressed'], d['ratio'] or 0, d['encoded'], d['wire'],
+               d['lines'], d['bytes_per_sec']))
+    if report['up']['resent'] or report['down']['damaged']:
+        log('(link: %d damaged lines received, %d frames sent again)\n'
+            % (report['down']['damaged'], report['up']['resent']))
+
+
+class Session(object):
+    """A running stage2 assembler, with jobs multiplexed over channels."""
+
+    def __init__(self, modem, reader, codec, splitter, stats=None,
+                 hold=(HOLD_MS, HOLD_BYTES)):
+        self.modem = modem
+        self.reader = reader
+        self.codec = codec
+        self.stats = stats or Stats()
+        self.hold = hold
+        self.split_end = '%s-EXIT-' % splitter
+        self.unshift = '%s-UNSHIFT ' % splitter
+        self.jobs = {}
+        self.next_ch = 1
+        self.watchers = []
+        self.framer = Framer(self._write, modem.speed)
+        self.rv = None  # the assembler's exit code, once it has exited
+
+    def _write(self, line):
+        os.write(self.modem.fd, line + '\n')
+        self.stats.sent(len(line) + 1)
+
+    def send(self, line):
+        self.framer.send(line)
+
+    def start(self, job):
+        """Start job on a new channel."""
+        job.session = self
+        job.ch = self.next_ch
+        self.next_ch += 1
+        self.jobs[job.ch] = job
+        self.send('R %d %s' % (job.ch, self.codec.encode('%s %s'
+                                                         % (job.kind,
+                                                            job.arg))))
+        job.start()
+        return job
+
+    def quit(self):
+        """Tell the assembler to exit once all its jobs are finished."""
+        self.send('Q')
+
+    def cancel(self, job):
+        """Have the assembler stop job early; it still gets done() later."""
+        self.send('K %d' % job.ch)
+
+    def abort(self):
+        """Make the assembler interrupt its jobs and exit, if it hasn't.
+
+        A line of nothing but ^C does that, whatever state the link is in;
+        the newline before it ends any line we were cut off in the middle
+        of.
+        """
+        if self.rv is None:
+            try:
+                os.write(self.modem.fd, '\n\x03\n')
+            except OSError:
+                pass
+
+    def unacked(self):
+        return sum(job.unacked() for job in self.jobs.values())
+
+    def watch(self, obj):
+        """Have run() service obj along with the jobs.
+
+        obj needs the rfds(), busy(), timeout() and step() methods of a Job.
+        """
+        self.watchers.append(obj)
+
+    def run(self):
+        """Service all jobs until the assembler exits; return its exit code."""
+        return port.Loop().call(self.serve())
+
+    def serve(self):
+        """Coroutine version of run(), for driving many sessions at once."""
+        while 1:
+            rl = [self.modem.fd]
+            timeout = self.stats.interval
+            t = self.framer.timeout()
+            if t is not None and (timeout is None or t < timeout):
+                timeout = t
+            for job in self.jobs.values() + self.watchers:
+                rl += job.rfds()
+                if job.busy():
+                    timeout = 0
+                t = job.timeout()
+                if t is not None and (timeout is None or t < timeout):
+                    timeout = t
+            r = yield rl, timeout
+            for job in self.jobs.values() + self.watchers:
+                job.step(r)
+            self.stats.tick()
+            if self.modem.fd in r:
+                nbuf = self.reader.fill(0)
                 trace(nbuf)
-                for line in reader.lines():
-                    if split_end in line:
-                        pre, rv = line.split(split_end, 1)
-                        assert not pre
-                        trace('(rv=%r)' % rv)
-                        sys.exit(int(rv))
-                    if line.startswith('1 '):
-                        os.write(1, decode(line[2:]))
-                    elif line.startswith('2 '):
-                        os.write(2, decode(line[2:]))
-                    elif (line.startswith('Traceback ') or
-                          line.startswith('ERROR')):
-                        log(line)
-                        while nbuf:
-                            nbuf = reader.fill(1)
-                            log(nbuf)
-                    else:
-                        while nbuf:
-                            nbuf = reader.fill(0.1)
-                            trace(nbuf)
-                        raise port.ModemError('unexpected prefix %r...'
-                                              % line[:15])
+                self.stats.received(len(nbuf))
+                for line in self.reader.lines():
+                    self.rv = self.got(line)
+                    if self.rv is not None:
+                        self.stats.phase('exec')
+                        raise port.Return(self.rv)
+            self.framer.step()
+            if (self.framer.unacked and
+                    time.time() - self.framer.heard > LINK_DEAD):
+                raise port.ModemError('no answer from the remote end in %ds'
+                                      % LINK_DEAD)
+
+    def got(self, line):
+        lines = self.framer.got(line.rstrip('\n'))
+        if lines is None and self.unshift in line:
+            # The assembler is going back to the rate it started at; see
+            # _unshift().
+            try:
+                self.modem.set_speed(int(line.split(self.unshift, 1)[1]))
+            except (ValueError, port.ModemError):
+                trace('(damaged: %r)\n' % line)
+            else:
+                os.write(self.modem.fd, 'ok\n')
+                trace('(speed: %d)\n' % self.modem.speed)
+            return None
+        elif lines is None:
+            return _other_line(self.reader, self.split_end, line)
+        for line in lines:
+            self._got(line)
+
+    def _got(self, line):
+        kind = line[:1]
+        if (kind not in ('1', '2', 'D', 'A', 'E', 'G', 'X') or
+                line[1:2] != ' '):
+            raise port.ModemError('unexpected line %r...' % line[:15])
+        words = line.split(' ', kind == 'D' and 3 or 2)
+        self.stats.lines[1] += 1
+        # Decode every payload in order, to keep the zlib stream in sync.
+        data = kind in ('1', '2', 'D') and self.codec.decode(words[-1]) or ''
+        if data:
+            self.stats.count({'1': 'stdout', '2': 'stderr',
+                              'D': 'pull'}[kind], len(data))
+        job = self.jobs.get(int(words[1]))
+        if not job:
+            pass
+        elif kind == 'X':
+            del self.jobs[job.ch]
+            job.done(int(words[2]))
+        else:
+            job.got(kind, words, data)
+
+
+def make_job(kind, arg, local='', prefix='', stdin=None):
+    """Return a new Job for a request given on the command line.
+
+    local is the local file name for push and pull.
+    """
+    if kind == 'push':
+        return PushJob(open(local, 'rb'), arg)
+    elif kind == 'pull':
+        return PullJob(arg, local)
+    else:
+        return RunJob(arg, stdin=stdin, prefix=prefix)
+
+
+def _hold(opt):
+    """Return the (ms, bytes) to coalesce for, from --coalesce and --bulk."""
+    if opt.bulk:
+        return BULK_HOLD
+    ms, nbytes = [int(v) for v in opt.coalesce.split(',')]
+    return max(ms, 0), max(nbytes, 1)
+
+
+def start_session(filename, opt):
+    """Log in on tty filename and start the stage2 assembler there."""
+    return port.Loop().call(connect(filename, opt))
+
+
+def connect(filename, opt):
+    """Coroutine version of start_session(); returns the Session."""
+    stats = Stats(opt.stats and 1.0 or None)
+    hold = _hold(opt)
+    modem = port.Modem(filename, opt.speed, float(opt.wait or 0))
+    reader = Reader(modem.fd)
+    yield get_shell_prompt(reader, opt.user, opt.password or '')
+    stats.phase('login')
+
+    splitter = os.urandom(16).encode('hex')
+    codec = Codec()
+
+    cpy_script = stage2_script()
+    script1 = PY_SCRIPT1.strip().replace('SPLITTER', splitter)
+    os.write(modem.fd, "%s\r" % script1.replace(
+        'HASH', hashlib.sha1(cpy_script).hexdigest()))
+    yield wait_for_string(reader, '%s-READY-' % splitter)
+    tries = 0
+    while (yield wait_for_string(reader, '\n')) == '1':
+        if tries == UPLOAD_TRIES:
+            raise port.ModemError('stage2 upload damaged %d times in a row'
+                                  % tries)
+        tries += 1
+        trace('(cpy_script=%d)' % len(cpy_script))
+        stats.upload += len(cpy_script)
+        for i in range(0, len(cpy_script), 1024):
+            os.write(modem.fd, "%s\r" % cpy_script[i:i+1024])
+        os.write(modem.fd, "\r")
+        yield wait_for_string(reader, '%s-READY-' % splitter)
+    yield negotiate(modem, reader, codec, splitter, opt.upshift, hold)
+    yield wait_for_string(reader, '%s-RUNNING\n' % splitter)
+    # Logging in is all round trips, so only now is --profile=bulk a win.
+    modem.set_profile(opt.profile)
+    stats.phase('bootstrap')
+    raise port.Return(Session(modem, reader, codec, splitter, stats, hold))
+
+
+def daemon_path(filename):
+    return os.path.join(tempfile.gettempdir(), 'portsh.%d.%s'
+                        % (os.getuid(), os.path.basename(filename)))
+
+
+def _send_frame(conn, tag, data):
+    conn.sendall('%s %d\n%s' % (tag, len(data), data))
+
+
+def _split_frames(buf):
+    """Return the complete frames at the start of buf, and the rest."""
+    frames = []
+    while 1:
+        eol = buf.find('\n')
+        if eol < 0:
+            break
+        tag, n = buf[:eol].split(' ')
+        end = eol + 1 + int(n)
+        if len(buf) < end:
+            break
+        frames.append((tag, buf[eol+1:end]))
+        buf = buf[end:]
+    return frames, buf
+
+
+class Daemon(object):
+    """Serves requests from thin portsh clients on a unix socket.
+
+    A client sends one 'R <length>' frame with the make_job() arguments,
+    separated by NULs, followed by the raw stdin for the job if it wants
+    any.  We answer with frames of the form '<tag> <length>\n<data>',
+    where tag is 1 or 2 for output, or X for the exit code.  If the client
+    goes away before that, its job is cancelled.
+    """
+
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self.clients = {}  # connection: job
+        self.pending = {}  # connection: [header, args] received so far
+        self.cancelled = set()  # connections whose jobs we've cancelled
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a dead daemon
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        session.watch(self)
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.path)
+        for job in self.clients.values():
+            if job.rv is None:
+                job.cancel()
+
+    def rfds(self):
+        return [self.sock] + self.pending.keys()
+
+    def busy(self):
+        # Finished jobs still need their exit code sent.
+        return [job for job in self.clients.values() if job.rv is not None]
+
+    def timeout(self):
+        # Look for clients that have gone away every so often, even if
+        # nothing else is happening; see hangups().
+        return self.clients and 1.0 or None
+
+    def step(self, r):
+        self.hangups()
+        if self.sock in r:
+            conn, addr = self.sock.accept()
+            self.pending[conn] = ['', '']
+        for conn in self.pending.keys():
+            if conn in r:
+                self.receive(conn)
+        for conn, job in self.clients.items():
+            if job.rv is not None:
+                self.output(conn, 'X', str(job.rv))
+                conn.close()
+                del self.clients[conn]
+                self.cancelled.discard(conn)
+
+    def output(self, conn, tag, data):
+        try:
+            _send_frame(conn, tag, data)
+        except socket.error:
+            self.hangup(conn)
+
+    def hangups(self):
+        """Cancel the jobs of clients that have gone away.
+
+        A client shuts down its side of the connection once it has no more
+        stdin to send, so end of file doesn't mean it's gone; poll() can
+        tell the difference.
+        """
+        p = select.poll()
+        conns = {}
+        for conn in self.clients:
+            p.register(conn, 0)  # POLLHUP and POLLERR are always reported
+            conns[conn.fileno()] = conn
+        for fd, event in p.poll(0):
+            self.hangup(conns[fd])
+
+    def hangup(self, conn):
+        job = self.clients.get(conn)
+        if job and job.rv is None and conn not in self.cancelled:
+            self.cancelled.add(conn)
+            self.session.cancel(job)
+
+    def receive(self, conn):
+        """Read what has come of conn's request; start it once it's all here.
+
+        We only read what select() says is there, so a client that is slow
+        to send its request can't hold up everyone else's jobs.
+        """
+        hdr, args = self.pending[conn]
+        try:
+            if hdr.endswith('\n'):
+                b = conn.recv(int(hdr.split(' ')[1]) - len(args))
+            else:
+                b = conn.recv(1)  # what comes after it may be stdin
+        except socket.error:
+            b = ''
+        if not b:
+            del self.pending[conn]
+            conn.close()
+            return
+        if hdr.endswith('\n'):
+            args += b
+        else:
+            hdr += b
+        if not hdr.endswith('\n') or len(args) < int(hdr.split(' ')[1]):
+            self.pending[conn] = [hdr, args]
+            return
+        del self.pending[conn]
+        kind, arg, local, prefix, want_stdin = args.split('\0')
+        try:
+            job = make_job(kind, arg, local, prefix,
+                           want_stdin and conn.fileno() or None)
+        except EnvironmentError, e:
+            self.output(conn, '2', '%s\n' % e)
+            self.output(conn, 'X', '1')
+            conn.close()
+            return
+        job.output = lambda fd, data: self.output(conn, str(fd), data)
+        self.clients[conn] = job
+        self.session.start(job)
+
+
+def run_client(path, specs):
+    """Have the daemon listening at path run specs; return their exit codes.
+
+    Raises socket.error if there is no daemon.  Once we're connected, the
+    daemon may have started the jobs, so a failure after that only fails
+    them; running them ourselves could run them twice.
+    """
+    # Anyone can put a socket there; only trust one of our own.
+    try:
+        st = os.lstat(path)
+    except OSError, e:
+        raise socket.error(e.errno, e.strerror)
+    if st.st_uid != os.getuid():
+        raise socket.error('%s: not ours' % path)
+    conns = []
+    for spec in specs:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        conns.append(conn)
+    for conn, (kind, arg, local, prefix, stdin) in zip(conns, specs):
+        try:
+            _send_frame(conn, 'R', '\0'.join([kind, arg, local, prefix,
+                                              stdin is not None and '1'
+                                              or '']))
+            if stdin is None:
+                conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass  # we'll find out when we read from it
+    rvs = [None] * len(conns)
+    bufs = [''] * len(conns)
+    stdin_conn = [c for c, spec in zip(conns, specs) if spec[4] is not None]
+    while None in rvs:
+        rl = [c for c, rv in zip(conns, rvs) if rv is None]
+        if stdin_conn and stdin_conn[0] in rl:
+            rl.append(0)
+        r,w,x = select.select(rl, [], [])
+        if 0 in r:
+            buf = os.read(0, 4096)
+            try:
+                if buf:
+                    stdin_conn[0].sendall(buf)
+                else:
+                    stdin_conn[0].shutdown(socket.SHUT_WR)
+                    stdin_conn = []
+            except socket.error:
+                stdin_conn = []
+        for i, conn in enumerate(conns):
+            if conn not in r:
+                continue
+            try:
+                b = conn.recv(65536)
+            except socket.error:
+                b = ''
+            if not b:
+                rvs[i] = 1  # the daemon died before telling us
+                log('portsh: lost connection to daemon\n')
+            frames, bufs[i] = _split_frames(bufs[i] + b)
+            for tag, data in frames:
+                if tag == 'X':
+                    rvs[i] = int(data)
+                else:
+                    os.write(int(tag), data)
+    return rvs
+
+
+class _FileJob(RunJob):
+    """A RunJob whose stdout and stderr both go to the file f."""
+
+    def __init__(self, cmd, f):
+        RunJob.__init__(self, cmd)
+        self.f = f
+
+    def output(self, fd, data):
+        self.f.write(data)
+
+    def done(self, rv):
+        RunJob.done(self, rv)
+        self.f.close()
+
+
+def _fan_worker(todo, results, live, cmd, opt):
+    """Run cmd on each tty in todo in turn, until there are none left.
+
+    Several of these share todo, which is how fan_out() limits how many
+    ttys are busy at once.  Each result is (exit code or error, seconds to
+    log in, total seconds).  live holds the sessions still running.
+    """
+    while todo:
+        filename = todo.pop(0)
+        name = os.path.basename(filename)
+        start = time.time()
+        session = None
+        try:
+            session = yield connect(filename, opt)
+            live.append(session)
+            if opt.outdir:
+                job = _FileJob(cmd, open(os.path.join(opt.outdir,
+                                                      name + '.out'), 'w'))
+            else:
+                job = RunJob(cmd, prefix='[%s] ' % name)
+            session.start(job)
+            session.quit()
+            rv = yield session.serve()
+            if job.rv is not None:
+                result = job.rv
+            else:
+                result = rv or 1  # it never told us how it went
+        except Exception, e:
+            # Whatever went wrong, it only went wrong for this tty.
+            if not isinstance(e, (port.ModemError, port.AlreadyLockedError,
+                                  EnvironmentError)):
+                e = '%s: %s' % (e.__class__.__name__, e)
+            log('[%s] portsh: %s\n' % (name, e))
+            result = str(e)
+        if session:
+            live.remove(session)
+            session.abort()
+            session.modem.close()
+        login = session and session.stats.phases.get('login')
+        results[filename] = (result, login, time.time() - start)
+
+
+def fan_out(filenames, cmd, opt):
+    """Run cmd on all of filenames, opt.jobs at a time, and sum up.
+
+    Returns the first nonzero exit code, in the order of filenames, or 1
+    if we didn't get one from some tty at all.
+    """
+    todo = list(filenames)
+    results = {}
+    live = []
+    loop = port.Loop()
+    for i in range(min(int(opt.jobs), len(todo))):
+        loop.spawn(_fan_worker(todo, results, live, cmd, opt))
+    try:
+        loop.run()
+    finally:
+        for session in live:
+            session.abort()
+    width = max(len(f) for f in filenames)
+    log('\n%-*s %6s %8s %8s\n' % (width, 'tty', 'rv', 'login', 'total'))
+    rvs = []
+    for filename in filenames:
+        result, login, total = results[filename]
+        if isinstance(result, int):
+            rvs.append(result)
+            log('%-*s %6d %7.2fs %7.2fs\n' % (width, filename, result,
+                                              login, total))
+        else:
+            rvs.append(1)
+            log('%-*s %6s %8s %7.2fs  %s\n' % (width, filename, '-', '-',
+                                               total, result))
+    return ([rv for rv in rvs if rv] + [0])[0]
+
+
+def _ttys(spec):
+    """Expand --fanout's list of ttys and globs into a list of ttys."""
+    filenames = []
+    for item in spec.split(','):
+        matches = sorted(glob.glob(item))
+        if not matches and not glob.has_magic(item):
+            matches = [item]
+        filenames += [f for f in matches if f not in filenames]
+    return filenames
+
+
+def save_stats(session, opt):
+    """Show and/or save the session statistics, as requested in opt."""
+    if opt.stats or opt.stats_json:
+        report = session.stats.report(session)
+        if opt.stats:
+            _show_stats(report)
+        if opt.stats_json:
+            f = open(opt.stats_json, 'w')
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+            f.close()
+
+
+def main():
+    o = options.Options(optspec)
+    (opt, flags, extra) = o.parse(sys.argv[1:])
+    if opt.trace:
+        global _want_trace
+        _want_trace = opt.trace
+    try:
+        _hold(opt)
+    except ValueError:
+        o.fatal('--coalesce expects MS,BYTES')
+    try:
+        float(opt.wait or 0)
+    except ValueError:
+        o.fatal('--wait expects a number of seconds')
+    if opt.profile not in port.PROFILES:
+        o.fatal('--profile should be one of: %s' % ', '.join(port.PROFILES))
+    if opt.fanout:
+        if opt.wait:
+            # waiting for a lock blocks the whole process, not just one tty
+            o.fatal('--wait does not work with --fanout')
+        filenames = _ttys(opt.fanout)
+        if not filenames:
+            o.fatal("--fanout matched no ttys")
+        if not extra:
+            o.fatal("a command expected")
+        if int(opt.jobs) < 1:
+            o.fatal("--jobs must be at least 1")
+        sys.exit(fan_out(filenames, ' '.join(extra), opt))
+    if opt.daemon:
+        if len(extra) != 1:
+            o.fatal("--daemon expects exactly one tty name")
+        filename = extra[0]
+        specs = []
+    elif extra and extra[0] in ('push', 'pull'):
+        if len(extra) != 4:
+            o.fatal("%s expects a tty name and two file names" % extra[0])
+        mode, filename, src, dst = extra
+        if mode == 'push':
+            specs = [('push', dst, os.path.abspath(src), '', None)]
+        else:
+            specs = [('pull', src, os.path.abspath(dst), '', None)]
+    else:
+        if len(extra) < 2:
+            o.fatal("exactly one tty name and a command expected")
+        filename = extra[0]
+        if opt.multi:
+            specs = [('run', cmd, '', '[%d] ' % (i + 1), None)
+                     for i, cmd in enumerate(extra[1:])]
+        else:
+            specs = [('run', ' '.join(extra[1:]), '', '', 0)]
+
+    # Open local files now, so a typo doesn't cost us a whole login.
+    jobs = [make_job(*spec) for spec in specs]
+    rv = 0
+    try:
+        try:
+            if opt.daemon:
+                raise socket.error('not a client')
+            rvs = run_client(daemon_path(filename), specs)
+        except socket.error:
+            session = start_session(filename, opt)
+            if opt.daemon:
+                daemon = Daemon(session, daemon_path(filename))
+                # Let a plain kill clean up the socket.
+                signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+                try:
+                    sys.exit(session.run())
+                finally:
+                    daemon.close()
+                    session.abort()
+                    session.stats.phase('exec')
+                    save_stats(session, opt)
+            for job in jobs:
+                session.start(job)
+            session.quit()
+            try:
+                rv = session.run()
+            finally:
+                session.abort()
+            rvs = [job.rv for job in jobs]
+            save_stats(session, opt)
+    finally:
+        # A daemon ran them instead, or they never got to finish.
+        for job in jobs:
+            if job.rv is None:
+                job.cancel()
+    if opt.multi:
+        for i, spec in enumerate(specs):
+            log('([%d] %s: exit code %s)\n' % (i + 1, spec[1], rvs[i]))
+    sys.exit(rv or ([jrv for jrv in rvs if jrv] + [0])[0])
 
 
 if __name__ == '__main__':
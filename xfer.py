@@ -0,0 +1,864 @@
+# Copyright 2011-2012 Avery Pennarun and port.py contributors.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in
+#       the documentation and/or other materials provided with the
+#       distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""XMODEM, YMODEM and ZMODEM file transfers over a tty.
+
+These are what boot ROMs and bootloaders (U-Boot's loadx, loady and
+friends) and lrzsz's sz/rz speak, so port can move files over the
+console it already has open instead of handing the tty to another
+program.  Everything works on a Link, which is just a file descriptor
+plus timeouts, so the same code runs on a Modem or an Attached server
+client.
+"""
+import binascii
+import os
+import re
+import select
+import struct
+import time
+
+SOH, STX, EOT, ACK, NAK, CAN, SUB = ('\x01', '\x02', '\x04', '\x06', '\x15',
+                                     '\x18', '\x1a')
+RETRIES = 10
+START_TIMEOUT = 60.0  # how long to wait for the other end to get going
+BLOCK_TIMEOUT = 10.0
+
+# ZMODEM frame types, escapes and capabilities, from Forsberg's zmodem.txt
+(ZRQINIT, ZRINIT, ZSINIT, ZACK, ZFILE, ZSKIP, ZNAK, ZABORT, ZFIN, ZRPOS,
+ ZDATA, ZEOF, ZFERR, ZCRC, ZCHALLENGE, ZCOMPL, ZCAN, ZFREECNT,
+ ZCOMMAND) = range(19)
+ZPAD, ZDLE = '*', '\x18'
+ZCRCE, ZCRCG, ZCRCQ, ZCRCW = 'hijk'  # end of subpacket: end, go, ack?, wait
+ZRUB0, ZRUB1 = 'lm'
+CANFDX, CANOVIO, CANFC32 = 0x01, 0x02, 0x20
+ZCBIN = 1
+ZSUBPACKET = 1024
+ZWINDOW = 32768  # bytes we'll stream ahead of the receiver's last ZACK
+
+_zesc_re = re.compile('[\x10\x11\x13\x18\x90\x91\x93\r\x8d]')
+_flowctl = '\x11\x13\x91\x93'  # XON/XOFF, which ZMODEM never sends raw
+
+
+class TransferError(Exception):
+    pass
+
+
+def _crc16(data):
+    return struct.pack('>H', binascii.crc_hqx(data, 0))
+
+
+def _crc32(data):
+    return struct.pack('<I', binascii.crc32(data) & 0xffffffff)
+
+
+def _zesc(data):
+    return _zesc_re.sub(lambda m: ZDLE + chr(ord(m.group()) ^ 0x40), data)
+
+
+class Link(object):
+    """A tty file descriptor with timeouts and pushback.
+
+    If abort_fd is given, typing ^C or ^X on it cancels the transfer.
+    """
+
+    def __init__(self, fd, abort_fd=None):
+        self.fd = fd
+        self.abort_fd = abort_fd
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self, timeout):
+        fds = [self.fd]
+        if self.abort_fd is not None:
+            fds.append(self.abort_fd)
+        r, w, x = select.select(fds, [], [], max(timeout, 0))
+        if self.abort_fd in r:
+            typed = os.read(self.abort_fd, 4096)
+            if '\x03' in typed or CAN in typed:
+                raise TransferError('cancelled')
+        if self.fd in r:
+            got = os.read(self.fd, 65536)
+            if not got:
+                raise TransferError('the tty went away')
+            self.buf = self.buf[self.pos:] + got
+            self.pos = 0
+            return True
+        return False
+
+    def read(self, timeout):
+        """Return whatever has arrived, waiting up to timeout for some."""
+        deadline = time.time() + timeout
+        while self.pos >= len(self.buf):
+            if not self._fill(deadline - time.time()) and \
+                    time.time() >= deadline:
+                return ''
+        out = self.buf[self.pos:]
+        self.buf, self.pos = '', 0
+        return out
+
+    def getc(self, timeout):
+        """Return the next byte, or None if none arrives in time."""
+        if self.pos >= len(self.buf) and not self.read_more(timeout):
+            return None
+        c = self.buf[self.pos]
+        self.pos += 1
+        return c
+
+    def read_more(self, timeout):
+        deadline = time.time() + timeout
+        while self.pos >= len(self.buf):
+            if not self._fill(deadline - time.time()) and \
+                    time.time() >= deadline:
+                return False
+        return True
+
+    def readn(self, n, timeout):
+        """Return the next n bytes, or fewer if they don't arrive in time."""
+        deadline = time.time() + timeout
+        while len(self.buf) - self.pos < n:
+            if not self._fill(deadline - time.time()) and \
+                    time.time() >= deadline:
+                break
+        out = self.buf[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+    def unget(self, data):
+        self.buf = data + self.buf[self.pos:]
+        self.pos = 0
+
+    def ready(self):
+        """Return true if input is waiting, without blocking."""
+        return self.pos < len(self.buf) or self._fill(0)
+
+    def write(self, data):
+        while data:
+            n = os.write(self.fd, data)
+            data = data[n:]
+
+    def purge(self, quiet=0.5):
+        """Throw away input until the line has been quiet for a while."""
+        self.buf, self.pos = '', 0
+        while self._fill(quiet):
+            self.buf, self.pos = '', 0
+
+    def cancel(self):
+        """Tell the other end to give up, in a way all three understand."""
+        self.write(CAN * 8 + '\b' * 8)
+
+
+class Progress(object):
+    """Shows how a transfer is going, at most a few times a second."""
+
+    def __init__(self, log, verb, name, total=None):
+        self.log = log
+        self.verb = verb
+        self.name = name
+        self.total = total
+        self.start = self.last = time.time()
+        self.done = 0
+
+    def _rate(self):
+        return self.done / max(time.time() - self.start, 0.001) / 1024
+
+    def update(self, done):
+        if self.total is not None:
+            done = min(done, self.total)  # not counting padding
+        self.done = done
+        now = time.time()
+        if now - self.last >= 0.25:
+            self.last = now
+            of = self.total is not None and '/%d' % self.total or ''
+            self.log('\r(%s %s: %d%s bytes, %.1f KB/s)  ',
+                     self.verb, self.name, done, of, self._rate())
+
+    def finish(self):
+        self.log('\r(%s %s: %d bytes in %.1fs, %.1f KB/s)  \n',
+                 self.verb, self.name, self.done,
+                 time.time() - self.start, self._rate())
+
+
+#
+# XMODEM and YMODEM
+#
+
+def _x_block(blkno, data, crc):
+    head = len(data) == 1024 and STX or SOH
+    blk = blkno & 0xff
+    if crc:
+        check = _crc16(data)
+    else:
+        check = chr(sum(bytearray(data)) & 0xff)
+    return head + chr(blk) + chr(0xff - blk) + data + check
+
+
+def _x_start(link):
+    """Wait for the receiver to ask for data; return 'C', 'G' or NAK."""
+    deadline = time.time() + START_TIMEOUT
+    cans = 0
+    while 1:
+        c = link.getc(deadline - time.time())
+        if c is None:
+            raise TransferError('the receiver never asked for data')
+        elif c in ('C', 'G', NAK):
+            return c
+        elif c == CAN:
+            cans += 1
+            if cans >= 2:
+                raise TransferError('cancelled by the receiver')
+        else:
+            cans = 0
+
+
+def _x_send(link, blkno, data, mode):
+    """Send one block and wait for the receiver to take it."""
+    pkt = _x_block(blkno, data, mode != NAK)
+    if mode == 'G':
+        link.write(pkt)  # YMODEM-g: the receiver gives up on any error
+        return
+    for i in range(RETRIES):
+        link.write(pkt)
+        deadline = time.time() + BLOCK_TIMEOUT
+        while 1:
+            c = link.getc(deadline - time.time())
+            if c == ACK:
+                return
+            elif c == NAK or c is None:
+                break
+            elif c == CAN and link.getc(1) == CAN:
+                raise TransferError('cancelled by the receiver')
+    raise TransferError('block %d was never acknowledged' % blkno)
+
+
+def _x_eot(link):
+    # some YMODEM receivers NAK the first EOT, to make sure it's not noise
+    for i in range(RETRIES):
+        link.write(EOT)
+        c = link.getc(BLOCK_TIMEOUT)
+        while c not in (ACK, NAK, None):
+            c = link.getc(BLOCK_TIMEOUT)
+        if c == ACK:
+            return
+    raise TransferError('end of file was never acknowledged')
+
+
+def _x_data(link, f, mode, blocksize, progress):
+    blkno = 1
+    while 1:
+        data = f.read(blocksize)
+        if not data:
+            break
+        if len(data) <= 128:
+            # don't pad a short tail out to a whole 1k block
+            data = data.ljust(128, SUB)
+        else:
+            data = data.ljust(blocksize, SUB)
+        _x_send(link, blkno, data, mode)
+        blkno += 1
+        progress.update(min(progress.done + len(data), f.tell()))
+    _x_eot(link)
+    progress.finish()
+
+
+def send_xmodem(link, filename, log, onek=False):
+    """Send filename with XMODEM, in 1k blocks if onek and the receiver
+    can check CRCs."""
+    f = open(filename, 'rb')
+    progress = Progress(log, 'sending', os.path.basename(filename),
+                        os.fstat(f.fileno()).st_size)
+    mode = _x_start(link)
+    _x_data(link, f, mode, onek and mode != NAK and 1024 or 128, progress)
+
+
+def _y_header(name, st):
+    info = '%s\0%d %o %o' % (name, st.st_size, int(st.st_mtime),
+                             st.st_mode & 07777)
+    return info.ljust(len(info) < 128 and 128 or 1024, '\0')
+
+
+def send_ymodem(link, filenames, log):
+    """Send filenames with YMODEM batch, or YMODEM-g if asked for it."""
+    for filename in filenames:
+        f = open(filename, 'rb')
+        st = os.fstat(f.fileno())
+        name = os.path.basename(filename)
+        progress = Progress(log, 'sending', name, st.st_size)
+        _x_send(link, 0, _y_header(name, st), _x_start(link))
+        _x_data(link, f, _x_start(link), 1024, progress)
+    _x_send(link, 0, '\0' * 128, _x_start(link))
+
+
+def _x_read_block(link, head, crc):
+    """Read the rest of a block; return (blkno, data), or None if damaged."""
+    size = head == STX and 1024 or 128
+    n = 2 + size + (crc and 2 or 1)
+    # Give up after a second of silence, not a second in all: a 1K block
+    # takes longer than that at 9600 baud.
+    deadline = time.time() + BLOCK_TIMEOUT
+    pkt = ''
+    while len(pkt) < n and time.time() < deadline:
+        got = link.readn(n - len(pkt), 1.0)
+        if not got:
+            break
+        pkt += got
+    if len(pkt) < n:
+        return None
+    blk, nblk, data = ord(pkt[0]), ord(pkt[1]), pkt[2:2+size]
+    if blk != 0xff - nblk:
+        return None
+    if crc:
+        ok = pkt[2+size:] == _crc16(data)
+    else:
+        ok = ord(pkt[-1]) == sum(bytearray(data)) & 0xff
+    return ok and (blk, data) or None
+
+
+def _x_receive(link, write, crc, progress, blkno=1, ymodem=False):
+    """Receive blocks, starting with blkno, up to the EOT.
+
+    Returns the data of block 0 if that's what blkno asked for (a YMODEM
+    header), otherwise passes each block to write().
+    """
+    poke = crc and 'C' or NAK
+    errors = 0
+    link.write(poke)
+    while 1:
+        c = link.getc(blkno <= 1 and 3.0 or BLOCK_TIMEOUT)
+        if c in (SOH, STX):
+            got = _x_read_block(link, c, crc)
+            if not got:
+                errors += 1
+                link.purge()
+                link.write(NAK)
+            elif got[0] == blkno & 0xff:
+                link.write(ACK)
+                if blkno == 0:
+                    return got[1]
+                write(got[1])
+                blkno += 1
+                errors = 0
+                poke = NAK
+                progress.update(progress.done + len(got[1]))
+            elif got[0] == (blkno - 1) & 0xff:
+                link.write(ACK)  # our ACK got lost, so it sent it again
+            else:
+                raise TransferError('expected block %d, got %d'
+                                    % (blkno & 0xff, got[0]))
+        elif c == EOT and blkno == 0:
+            link.write(ACK)  # the last file's EOT, ACKed once already
+        elif c == EOT:
+            # like lrzsz, take it as line noise if more data follows it
+            c = link.getc(0.1)
+            if c is not None:
+                link.unget(c)
+                continue
+            link.write(ACK)
+            progress.finish()
+            return
+        elif c == CAN:
+            if link.getc(1) == CAN:
+                raise TransferError('cancelled by the sender')
+        elif c is None:
+            errors += 1
+            if crc and blkno == 1 and not ymodem and errors == 4:
+                crc = False  # it must be an old sender, without CRCs
+                poke = NAK
+            link.write(poke)
+        if errors > RETRIES:
+            raise TransferError('too many errors')
+
+
+def receive_xmodem(link, filename, log):
+    """Receive one file with XMODEM into filename.
+
+    XMODEM doesn't say how long the file was, so it keeps its padding.
+    """
+    f = open(filename, 'wb')
+    try:
+        _x_receive(link, f.write, True,
+                   Progress(log, 'receiving', os.path.basename(filename)))
+    finally:
+        f.close()
+
+
+def receive_ymodem(link, directory, log):
+    """Receive a YMODEM batch into directory; return the files' names."""
+    names = []
+    while 1:
+        info = _x_receive(link, None, True, None, blkno=0)
+        name, rest = info.split('\0', 1)
+        if not name:
+            return names
+        name = os.path.basename(name)
+        fields = rest.split('\0', 1)[0].split()
+        size = fields and int(fields[0]) or None
+        f = open(os.path.join(directory, name), 'wb')
+        progress = Progress(log, 'receiving', name, size)
+        left = [size]
+        def write(data):
+            if left[0] is not None:
+                data = data[:left[0]]
+                left[0] -= len(data)
+            f.write(data)
+        try:
+            _x_receive(link, write, True, progress, ymodem=True)
+        finally:
+            f.close()
+        names.append(name)
+
+
+#
+# ZMODEM
+#
+
+class ZModem(object):
+    """A ZMODEM sender or receiver on link.
+
+    Headers from the other end are (type, 4-byte argument) pairs; positions
+    in the argument are little-endian, flags are big-endian.
+    """
+
+    def __init__(self, link, log):
+        self.link = link
+        self.log = log
+        self.crc32 = False  # whether our binary headers and data use CRC-32
+        self.rx_crc32 = False  # whether the last header we got did
+        self.asked = 0  # when we last sent a ZRPOS
+
+    def send_hex(self, ftype, arg='\0\0\0\0'):
+        hdr = chr(ftype) + arg
+        tail = ftype not in (ZACK, ZFIN) and '\x11' or ''
+        self.link.write(ZPAD + ZPAD + ZDLE + 'B' +
+                        binascii.hexlify(hdr + _crc16(hdr)) + '\r\x8a' + tail)
+
+    def send_bin(self, ftype, arg='\0\0\0\0'):
+        hdr = chr(ftype) + arg
+        if self.crc32:
+            self.link.write(ZPAD + ZDLE + 'C' + _zesc(hdr + _crc32(hdr)))
+        else:
+            self.link.write(ZPAD + ZDLE + 'A' + _zesc(hdr + _crc16(hdr)))
+
+    def send_data(self, data, end):
+        check = self.crc32 and _crc32(data + end) or _crc16(data + end)
+        self.link.write(_zesc(data) + ZDLE + end + _zesc(check))
+
+    def _getc(self, timeout):
+        """Return an unescaped byte, ZDLE+end for a subpacket end, or None."""
+        link = self.link
+        c = link.getc(timeout)
+        while c is not None and c in _flowctl:
+            c = link.getc(timeout)
+        if c != ZDLE:
+            return c
+        c = link.getc(timeout)
+        while c is not None and c in _flowctl:
+            c = link.getc(timeout)
+        if c is None:
+            return None
+        elif c in (ZCRCE, ZCRCG, ZCRCQ, ZCRCW):
+            return ZDLE + c
+        elif c == ZRUB0:
+            return '\x7f'
+        elif c == ZRUB1:
+            return '\xff'
+        elif c == CAN:
+            if link.readn(3, 1.0) == CAN * 3:
+                raise TransferError('cancelled by the other end')
+            return None
+        elif ord(c) & 0x60 == 0x40:
+            return chr(ord(c) ^ 0x40)
+        return None
+
+    def recv_header(self, timeout):
+        """Return the next (type, arg) header, or None if it's garbled or
+        doesn't come in time."""
+        link = self.link
+        deadline = time.time() + timeout
+        cans = 0
+        while 1:
+            c = link.getc(deadline - time.time())
+            if c is None:
+                return None
+            elif c == CAN:
+                cans += 1
+                if cans >= 5:
+                    raise TransferError('cancelled by the other end')
+                continue
+            cans = 0
+            if c != ZPAD:
+                continue
+            while c == ZPAD:
+                c = link.getc(1.0)
+            if c != ZDLE:
+                continue
+            kind = link.getc(1.0)
+            if kind == 'B':
+                try:
+                    hdr = binascii.unhexlify(link.readn(14, 1.0))
+                except TypeError:
+                    return None
+                for eol in ('\r\x8d', '\n\x8a', '\x11'):
+                    c = link.getc(0)
+                    if c is not None and c not in eol:
+                        link.unget(c)
+                if _crc16(hdr[:5]) != hdr[5:]:
+                    return None
+                self.rx_crc32 = False
+            elif kind in ('A', 'C'):
+                hdr = ''
+                for i in range(kind == 'A' and 7 or 9):
+                    c = self._getc(1.0)
+                    if c is None or len(c) != 1:
+                        return None
+                    hdr += c
+                check = kind == 'A' and _crc16 or _crc32
+                if check(hdr[:5]) != hdr[5:]:
+                    return None
+                self.rx_crc32 = kind == 'C'
+            else:
+                continue
+            return ord(hdr[0]), hdr[1:5]
+
+    def recv_data(self, limit=8192):
+        """Return the next data subpacket as (data, end), or None if it's
+        damaged or too long."""
+        link = self.link
+        parts = []
+        size = 0
+        while 1:
+            chunk = link.read(BLOCK_TIMEOUT)
+            if not chunk:
+                return None
+            i = chunk.find(ZDLE)
+            if i >= 0:
+                link.unget(chunk[i:])
+                chunk = chunk[:i]
+            chunk = chunk.translate(None, _flowctl)
+            parts.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                return None
+            if i >= 0:
+                c = self._getc(BLOCK_TIMEOUT)
+                if c is None:
+                    return None
+                elif len(c) == 2:
+                    end = c[1]
+                    break
+                parts.append(c)
+                size += 1
+        data = ''.join(parts)
+        check = ''
+        for i in range(self.rx_crc32 and 4 or 2):
+            c = self._getc(1.0)
+            if c is None or len(c) != 1:
+                return None
+            check += c
+        if (self.rx_crc32 and _crc32 or _crc16)(data + end) != check:
+            return None
+        return data, end
+
+    #
+    # Sending
+    #
+
+    def send(self, filenames):
+        """Send filenames as a ZMODEM batch."""
+        rxbuf = self._await_rinit()
+        left = sum(os.path.getsize(fn) for fn in filenames)
+        for i, filename in enumerate(filenames):
+            left -= self._send_file(filename, len(filenames) - i, left,
+                                    rxbuf)
+        # Everything's been delivered, so a lost ZFIN isn't worth failing
+        # over, or waiting long for.
+        try:
+            for i in range(3):
+                self.send_hex(ZFIN)
+                h = self.recv_header(2.0)
+                if h and h[0] == ZFIN:
+                    break
+            self.link.write('OO')
+        except TransferError:
+            pass
+
+    def _await_rinit(self):
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline:
+            self.send_hex(ZRQINIT)
+            h = self.recv_header(5.0)
+            if not h:
+                continue
+            ftype, arg = h
+            if ftype == ZRINIT:
+                rxbuf, zf1, zf0 = struct.unpack('<HBB', arg)
+                self.crc32 = bool(zf0 & CANFC32)
+                return rxbuf
+            elif ftype == ZCHALLENGE:
+                self.send_hex(ZACK, arg)
+            elif ftype in (ZCAN, ZABORT):
+                raise TransferError('cancelled by the receiver')
+        raise TransferError('the receiver never answered; is rz running?')
+
+    def _send_file(self, filename, files, left, rxbuf):
+        """Send one file; return its size."""
+        f = open(filename, 'rb')
+        st = os.fstat(f.fileno())
+        name = os.path.basename(filename)
+        info = '%s\0%d %o %o 0 %d %d\0' % (name, st.st_size,
+                                           int(st.st_mtime),
+                                           st.st_mode & 07777, files, left)
+        for i in range(RETRIES):
+            self.send_bin(ZFILE, '\0\0\0' + chr(ZCBIN))
+            self.send_data(info, ZCRCW)
+            h = self.recv_header(BLOCK_TIMEOUT)
+            while h and h[0] == ZRINIT:
+                # probably an extra answer to our ZRQINIT; if nothing else
+                # follows, it missed the ZFILE
+                h = self.recv_header(1.0)
+            while h and h[0] == ZCRC:
+                # it wants to know if it already has the file
+                crc = binascii.crc32(open(filename, 'rb').read())
+                self.send_hex(ZCRC, struct.pack('<i', crc))
+                h = self.recv_header(BLOCK_TIMEOUT)
+            if not h or h[0] in (ZRINIT, ZNAK):
+                continue
+            elif h[0] == ZRPOS:
+                break
+            elif h[0] == ZSKIP:
+                self.log('(skipped %s)\n', name)
+                return st.st_size
+            elif h[0] in (ZCAN, ZABORT, ZFERR):
+                raise TransferError('cancelled by the receiver')
+        else:
+            raise TransferError('the receiver never accepted %s' % name)
+        progress = Progress(self.log, 'sending', name, st.st_size)
+        self._send_data(f, st.st_size, struct.unpack('<I', h[1])[0],
+                        rxbuf, progress)
+        progress.finish()
+        return st.st_size
+
+    def _send_data(self, f, size, pos, rxbuf, progress):
+        """Stream the file from pos, going back whenever asked to."""
+        window = rxbuf or ZWINDOW
+        blocksize = min(ZSUBPACKET, window)
+        good = 0
+        errors = 0
+        failed = -1  # where we last had to go back to
+        while 1:
+            self.send_bin(ZDATA, struct.pack('<I', pos))
+            f.seek(pos)
+            acked = asked = pos
+            restart = end = None
+            while restart is None and end not in (ZCRCE, ZCRCW):
+                data = f.read(blocksize)
+                pos += len(data)
+                if pos >= size:
+                    end = ZCRCE
+                elif pos - acked + blocksize > window:
+                    end = ZCRCW  # ends the frame until it catches up
+                elif pos - asked >= window // 4:
+                    end = ZCRCQ
+                    asked = pos
+                else:
+                    end = ZCRCG
+                self.send_data(data, end)
+                progress.update(pos)
+                good += 1
+                if good >= 16 and blocksize < min(ZSUBPACKET, window):
+                    blocksize *= 2  # the line seems to have cleaned up
+                    good = 0
+                # Deal with anything the receiver said, and if we're too far
+                # ahead of it, wait until it catches up.
+                while 1:
+                    waiting = end == ZCRCW and acked < pos
+                    if restart is not None or not (waiting or
+                                                   self.link.ready()):
+                        break
+                    h = self.recv_header(waiting and BLOCK_TIMEOUT or 1.0)
+                    if not h:
+                        if waiting:
+                            restart = acked
+                    elif h[0] == ZACK:
+                        acked = max(acked, struct.unpack('<I', h[1])[0])
+                    elif h[0] == ZRPOS:
+                        restart = struct.unpack('<I', h[1])[0]
+                    elif h[0] in (ZSKIP, ZCAN, ZABORT, ZFERR):
+                        raise TransferError('cancelled by the receiver')
+            if restart is None and end == ZCRCW:
+                continue  # caught up, so start a new frame
+            if restart is None:
+                for i in range(RETRIES):
+                    self.send_bin(ZEOF, struct.pack('<I', size))
+                    h = self.recv_header(BLOCK_TIMEOUT)
+                    while h and h[0] == ZACK:
+                        h = self.recv_header(BLOCK_TIMEOUT)
+                    if h and h[0] == ZRINIT:
+                        return
+                    elif h and h[0] == ZRPOS:
+                        restart = struct.unpack('<I', h[1])[0]
+                        break
+                    elif h and h[0] in (ZSKIP, ZCAN, ZABORT, ZFERR):
+                        raise TransferError('cancelled by the receiver')
+                else:
+                    raise TransferError('end of file was never acknowledged')
+            if restart > failed:
+                errors = 0
+            errors += 1
+            if errors > RETRIES:
+                raise TransferError('too many errors at byte %d' % restart)
+            failed = pos = min(restart, size)
+            # smaller subpackets have a better chance on a noisy line
+            blocksize = max(64, blocksize // 2)
+            good = 0
+            self.link.purge(0)
+
+    #
+    # Receiving
+    #
+
+    def _rpos(self, pos, again=False):
+        """Ask the sender to go back to pos.
+
+        With again, don't bother if we just asked: it's probably still
+        sending what it sent before it heard us.
+        """
+        if again and time.time() - self.asked < 1.0:
+            return
+        self.asked = time.time()
+        self.send_hex(ZRPOS, struct.pack('<I', pos))
+
+    def _rinit(self):
+        self.send_hex(ZRINIT, struct.pack('<HBB', 0, 0,
+                                          CANFDX | CANOVIO | CANFC32))
+
+    def receive(self, directory):
+        """Receive a ZMODEM batch into directory; return the files' names.
+
+        Files that already exist are skipped rather than overwritten.
+        """
+        names = []
+        f = progress = None
+        pos = 0
+        errors = 0
+        self._rinit()
+        while 1:
+            h = self.recv_header(BLOCK_TIMEOUT)
+            if not h:
+                errors += 1
+                if errors > RETRIES:
+                    raise TransferError('too many errors')
+                if f:
+                    self.link.purge(0.1)
+                    self._rpos(pos)
+                else:
+                    self._rinit()
+                continue
+            ftype, arg = h
+            if ftype == ZRQINIT:
+                self._rinit()
+            elif ftype == ZSINIT:
+                if self.recv_data():
+                    self.send_hex(ZACK)
+                else:
+                    self.send_hex(ZNAK)
+            elif ftype == ZFILE:
+                got = self.recv_data()
+                if not got:
+                    self.send_hex(ZNAK)
+                    continue
+                name, rest = got[0].split('\0', 1)
+                name = os.path.basename(name)
+                fields = rest.split('\0', 1)[0].split()
+                path = os.path.join(directory, name)
+                if f and f.name == path:
+                    # it didn't hear our ZRPOS
+                    self._rpos(pos)
+                    continue
+                if not name or os.path.exists(path):
+                    self.log('(skipping %s: it already exists)\n', name)
+                    self.send_hex(ZSKIP)
+                    continue
+                f = open(path, 'wb')
+                names.append(name)
+                progress = Progress(self.log, 'receiving', name,
+                                    fields and int(fields[0]) or None)
+                pos = 0
+                self._rpos(pos)
+            elif ftype == ZDATA and f:
+                if struct.unpack('<I', arg)[0] != pos:
+                    # it didn't hear our ZRPOS, or it's catching up to it
+                    errors += 1
+                    self._rpos(pos, again=True)
+                    continue
+                while 1:
+                    got = self.recv_data()
+                    if not got:
+                        errors += 1
+                        if errors > RETRIES:
+                            raise TransferError('too many errors')
+                        # the header reader skips whatever it sends until
+                        # it hears this and starts over
+                        self._rpos(pos)
+                        break
+                    data, end = got
+                    f.write(data)
+                    pos += len(data)
+                    errors = 0
+                    progress.update(pos)
+                    if end in (ZCRCQ, ZCRCW):
+                        self.send_hex(ZACK, struct.pack('<I', pos))
+                    if end in (ZCRCE, ZCRCW):
+                        break
+            elif ftype == ZEOF and f:
+                if struct.unpack('<I', arg)[0] == pos:
+                    f.close()
+                    f = None
+                    progress.finish()
+                    self._rinit()
+                else:
+                    self._rpos(pos, again=True)
+            elif ftype == ZEOF:
+                self._rinit()  # it missed the one after the last file
+            elif ftype == ZFIN:
+                self.send_hex(ZFIN)
+                self.link.readn(2, 1.0)  # the 'OO' that ends the session
+                return names
+            elif ftype in (ZCAN, ZABORT):
+                raise TransferError('cancelled by the sender')
+            elif ftype == ZCOMMAND:
+                self.recv_data()
+                self.send_hex(ZCOMPL, struct.pack('<i', -1))
+
+
+def send_zmodem(link, filenames, log):
+    """Send filenames with ZMODEM; the other end should be running rz."""
+    ZModem(link, log).send(filenames)
+
+
+def receive_zmodem(link, directory, log):
+    """Receive files with ZMODEM into directory; return their names."""
+    return ZModem(link, log).receive(directory)